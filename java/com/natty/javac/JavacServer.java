@@ -0,0 +1,151 @@
+package com.natty.javac;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.StringWriter;
+import java.net.URI;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.List;
+
+import javax.tools.FileObject;
+import javax.tools.ForwardingJavaFileManager;
+import javax.tools.JavaCompiler;
+import javax.tools.JavaFileManager;
+import javax.tools.JavaFileObject;
+import javax.tools.SimpleJavaFileObject;
+import javax.tools.StandardJavaFileManager;
+import javax.tools.StandardLocation;
+import javax.tools.ToolProvider;
+
+/**
+ * A long-lived javac process that validates Natty-generated Java sources without paying JVM
+ * startup on every compilation.
+ *
+ * <p>Requests are read from stdin and responses written to stdout as big-endian, length-prefixed
+ * frames. A string frame is a 4-byte length followed by that many bytes of UTF-8. Sources are sent
+ * in-memory, so they never need to be written to disk before being validated.
+ *
+ * <pre>
+ * request:  [classpath: string] [file count: int] ([file name: string] [source: string])*
+ * response: [success: boolean] [compiler output: string]
+ * </pre>
+ *
+ * <p>The server exits when stdin is closed.
+ */
+public class JavacServer {
+    public static void main(String[] args) throws IOException {
+        JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+        if (compiler == null) {
+            System.err.println("No system Java compiler available. Is this running on a JDK?");
+            System.exit(1);
+        }
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        DataOutputStream out = new DataOutputStream(new BufferedOutputStream(System.out));
+
+        while (true) {
+            String classpath;
+            try {
+                classpath = readString(in);
+            } catch (EOFException e) {
+                return;  // The client closed stdin, we're done.
+            }
+            int fileCount = in.readInt();
+            List<JavaFileObject> files = new ArrayList<>(fileCount);
+            for (int i = 0; i < fileCount; i++) {
+                String fileName = readString(in);
+                files.add(new InMemorySourceFile(fileName, readString(in)));
+            }
+
+            // The classpath is set even when empty, since it would default to the server's own.
+            List<File> classpathJars = new ArrayList<>();
+            if (!classpath.isEmpty()) {
+                for (String jar : classpath.split(File.pathSeparator)) {
+                    classpathJars.add(new File(jar));
+                }
+            }
+
+            StringWriter compilerOutput = new StringWriter();
+            boolean success;
+            // A file manager per request, closed once it's done, so that the jars it opened are
+            // never held open between requests or read stale after Bazel rebuilds them.
+            try (StandardJavaFileManager standardFileManager =
+                    compiler.getStandardFileManager(null, null, StandardCharsets.UTF_8)) {
+                standardFileManager.setLocation(StandardLocation.CLASS_PATH, classpathJars);
+                // Class files are only produced as a side effect of validation, so they're
+                // discarded.
+                JavaFileManager fileManager = new DiscardingOutputFileManager(standardFileManager);
+                success = compiler.getTask(
+                        compilerOutput,
+                        fileManager,
+                        null,
+                        null,
+                        null,
+                        files).call();
+            } catch (RuntimeException e) {
+                success = false;
+                compilerOutput.write("Compiler crashed: " + e);
+            }
+
+            out.writeBoolean(success);
+            writeString(out, compilerOutput.toString());
+            out.flush();
+        }
+    }
+
+    /** Discards every file javac writes, rather than writing it to disk. */
+    private static final class DiscardingOutputFileManager
+            extends ForwardingJavaFileManager<JavaFileManager> {
+        DiscardingOutputFileManager(JavaFileManager fileManager) {
+            super(fileManager);
+        }
+
+        @Override
+        public JavaFileObject getJavaFileForOutput(
+                Location location, String className, JavaFileObject.Kind kind, FileObject sibling) {
+            URI uri = URI.create("discarded:///" + className.replace('.', '/') + kind.extension);
+            return new SimpleJavaFileObject(uri, kind) {
+                @Override
+                public OutputStream openOutputStream() {
+                    return OutputStream.nullOutputStream();
+                }
+            };
+        }
+    }
+
+    /**
+     * A source file held in memory. javac still checks the public class name against the file
+     * name, which is taken from the end of the URI path.
+     */
+    private static final class InMemorySourceFile extends SimpleJavaFileObject {
+        private final String source;
+
+        InMemorySourceFile(String fileName, String source) {
+            super(URI.create("string:///" + fileName), JavaFileObject.Kind.SOURCE);
+            this.source = source;
+        }
+
+        @Override
+        public CharSequence getCharContent(boolean ignoreEncodingErrors) {
+            return source;
+        }
+    }
+
+    private static String readString(DataInputStream in) throws IOException {
+        byte[] bytes = new byte[in.readInt()];
+        in.readFully(bytes);
+        return new String(bytes, StandardCharsets.UTF_8);
+    }
+
+    private static void writeString(DataOutputStream out, String s) throws IOException {
+        byte[] bytes = s.getBytes(StandardCharsets.UTF_8);
+        out.writeInt(bytes.length);
+        out.write(bytes);
+    }
+}
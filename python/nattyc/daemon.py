@@ -0,0 +1,365 @@
+import argparse
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import os
+import struct
+import sys
+import tempfile
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from typing import Any
+
+from python.nattyc.javac_server import javac_server_scope
+from python.nattyc.logging_setup import LOG_FORMAT
+
+# Runs a single invocation of a CLI in-process given its arguments, returning its exit code.
+CommandRunner = Callable[[list[str]], Awaitable[int]]
+
+
+async def _run_generate(argv: list[str]) -> int:
+    """Runs a single nattyc invocation, importing the CLI on first use."""
+    from python.nattyc.main import run
+
+    return await run(argv)
+
+
+async def _run_describe(argv: list[str]) -> int:
+    """Runs a single generate_usage_description invocation, importing the CLI on first use."""
+    from python.nattyc.generate_usage_description import run
+
+    return await run(argv)
+
+
+COMMANDS: dict[str, CommandRunner] = {
+    "generate": _run_generate,
+    "describe": _run_describe,
+}
+
+# The longest WorkRequest the persistent worker accepts.
+MAX_WORK_REQUEST_BYTES = 64 * 1024 * 1024
+
+# The buffer that logs emitted on behalf of the current request are captured in. asyncio copies
+# context into every task it creates, so this follows a request through all of its concurrent work.
+_request_output: contextvars.ContextVar[io.StringIO | None] = contextvars.ContextVar(
+    "_request_output", default=None
+)
+
+
+class _RequestLogHandler(logging.Handler):
+    """Routes each log record to the output of the request that emitted it."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            (_request_output.get() or sys.stderr).write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+
+def setup_request_logging(level: int = logging.INFO) -> None:
+    """Set up logging so that each request's logs are returned to its client.
+
+    This must run before any request is handled, so that the CLIs' own logging setup is a no-op.
+
+    Args:
+        level: The logging level to use
+    """
+    handler = _RequestLogHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.basicConfig(level=level, handlers=[handler])
+
+
+def expand_param_files(argv: list[str]) -> list[str]:
+    """Expands Bazel @param_file arguments into the arguments they contain.
+
+    Args:
+        argv: Command line arguments, any of which may be an @param_file in "multiline" format
+
+    Returns:
+        The arguments with every @param_file replaced by its contents
+    """
+    expanded: list[str] = []
+    for arg in argv:
+        if arg.startswith("@") and not arg.startswith("@@"):
+            expanded.extend(Path(arg[1:]).read_text().splitlines())
+        else:
+            expanded.append(arg)
+    return expanded
+
+
+async def run_captured(run: CommandRunner, argv: list[str]) -> tuple[int, str]:
+    """Runs a single invocation, capturing everything it logs.
+
+    Args:
+        run: Runs the invocation
+        argv: The invocation's command line arguments
+
+    Returns:
+        The invocation's exit code and logs
+    """
+    output = io.StringIO()
+    token = _request_output.set(output)
+    try:
+        exit_code = await run(expand_param_files(argv))
+    except Exception as e:
+        # Never let one bad request take down the whole process
+        logging.getLogger(__name__).error(f"Error: {str(e)}")
+        exit_code = 1
+    finally:
+        _request_output.reset(token)
+    return exit_code, output.getvalue()
+
+
+async def serve_persistent_worker(run: CommandRunner) -> None:
+    """Serves Bazel's JSON persistent worker protocol on stdin/stdout.
+
+    Each WorkRequest is handled concurrently with any others in flight, all sharing the one Gemini
+    client and javac server, until Bazel closes stdin.
+
+    Args:
+        run: Runs a single invocation given the WorkRequest's arguments
+    """
+    from python.nattyc.llm import client_scope
+
+    # Stdout is reserved for WorkResponses, anything else written there would corrupt the protocol
+    responses = sys.stdout
+    sys.stdout = sys.stderr
+    setup_request_logging()
+
+    loop = asyncio.get_running_loop()
+    # WorkRequests list every input along with its digest, so a single line can be very long
+    reader = asyncio.StreamReader(limit=MAX_WORK_REQUEST_BYTES)
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+    )
+
+    def respond(request_id: int, exit_code: int, output: str) -> None:
+        response = {"exitCode": exit_code, "output": output, "requestId": request_id}
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+
+    async def handle(request: dict[str, Any]) -> None:
+        exit_code, output = await run_captured(run, request["arguments"])
+        respond(request.get("requestId", 0), exit_code, output)
+
+    tasks: set[asyncio.Task[None]] = set()
+    async with client_scope(), javac_server_scope():
+        # Requests are usually one per line, but buffer until a complete JSON object arrives
+        pending = ""
+        while True:
+            try:
+                line = await reader.readline()
+                if not line:
+                    break
+                pending += line.decode()
+                request = json.loads(pending)
+            except json.JSONDecodeError as e:
+                # Valid JSON never has a line break inside a string, so an error before the end
+                # of what's been read so far means the request is malformed rather than incomplete
+                if e.pos >= len(pending.rstrip()):
+                    continue
+                pending = ""
+                respond(0, 1, f"Malformed WorkRequest: {str(e)}\n")
+                continue
+            except ValueError as e:
+                # Either the request wasn't UTF-8, or it was longer than MAX_WORK_REQUEST_BYTES
+                pending = ""
+                respond(0, 1, f"Malformed WorkRequest: {str(e)}\n")
+                continue
+            pending = ""
+
+            if not isinstance(request, dict) or not isinstance(
+                request.get("arguments", []), list
+            ):
+                request_id = (
+                    request.get("requestId", 0) if isinstance(request, dict) else 0
+                )
+                respond(request_id, 1, "Malformed WorkRequest\n")
+                continue
+            request.setdefault("arguments", [])
+            task = asyncio.create_task(handle(request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+
+def run_cli(main: Callable[[list[str]], object], run: CommandRunner) -> None:
+    """Entry point shared by the nattyc binaries.
+
+    Serves Bazel's persistent worker protocol when started with --persistent_worker, and otherwise
+    runs a single invocation.
+
+    Args:
+        main: Runs a single invocation as a standalone process
+        run: Runs a single invocation in-process, for use by the persistent worker
+    """
+    argv = sys.argv[1:]
+    if "--persistent_worker" in argv:
+        asyncio.run(serve_persistent_worker(run))
+    else:
+        main(expand_param_files(argv))
+
+
+def get_socket_path() -> Path:
+    """Returns the default path of the daemon's Unix socket."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return Path(runtime_dir) / "nattyc.sock"
+    return Path(tempfile.gettempdir()) / f"nattyc-{os.getuid()}.sock"
+
+
+class _FrameLengthError(ValueError):
+    """A frame's length prefix was out of range, so the stream can't be resynchronized."""
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Any:
+    """Reads a length-prefixed JSON frame, returning None once the stream is closed.
+
+    Raises:
+        _FrameLengthError: If the length prefix is negative or over MAX_WORK_REQUEST_BYTES
+        ValueError: If the frame isn't UTF-8 encoded JSON
+    """
+    try:
+        (length,) = struct.unpack(">i", await reader.readexactly(4))
+        if not 0 <= length <= MAX_WORK_REQUEST_BYTES:
+            raise _FrameLengthError(f"Frame length {length} is out of range")
+        data = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return json.loads(data)
+
+
+async def _write_frame(writer: asyncio.StreamWriter, message: Any) -> None:
+    """Writes a length-prefixed JSON frame."""
+    data = json.dumps(message).encode()
+    writer.write(struct.pack(">i", len(data)) + data)
+    await writer.drain()
+
+
+async def _handle_connection(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Handles requests from one client connection until the client disconnects.
+
+    Requests are {"cmd": "generate" | "describe", "args": [...], "cwd": "..."} and responses are
+    {"exit_code": int, "output": str}.
+    """
+    try:
+        while True:
+            try:
+                request = await _read_frame(reader)
+            except _FrameLengthError as e:
+                # Without a valid length there's no telling where the next frame starts
+                await _write_frame(
+                    writer, {"exit_code": 1, "output": f"Malformed request: {e}\n"}
+                )
+                break
+            except ValueError as e:
+                await _write_frame(
+                    writer, {"exit_code": 1, "output": f"Malformed request: {e}\n"}
+                )
+                continue
+            if request is None:
+                break
+            await _write_frame(writer, await _handle_request(request))
+    finally:
+        writer.close()
+
+
+async def _handle_request(request: Any) -> dict[str, Any]:
+    """Runs a single request read from a client connection, returning its response."""
+    if not isinstance(request, dict) or not isinstance(request.get("args", []), list):
+        return {"exit_code": 1, "output": "Malformed request\n"}
+    run = COMMANDS.get(request.get("cmd"))
+    if run is None:
+        return {"exit_code": 2, "output": f"Unknown command {request.get('cmd')!r}\n"}
+    if request.get("cwd", os.getcwd()) != os.getcwd():
+        # Relative paths are resolved against the daemon's own working directory
+        return {
+            "exit_code": 2,
+            "output": f"The daemon is serving {os.getcwd()}, not {request['cwd']}\n",
+        }
+    exit_code, output = await run_captured(run, request.get("args", []))
+    return {"exit_code": exit_code, "output": output}
+
+
+async def serve(socket_path: Path) -> None:
+    """Serves requests on a Unix socket until cancelled.
+
+    Every request is handled in this one process, sharing its Gemini client and javac server, so
+    invocations skip Python startup, SDK imports and connection setup.
+
+    Args:
+        socket_path: Path of the Unix socket to listen on
+    """
+    from python.nattyc.llm import client_scope
+
+    setup_request_logging()
+    socket_path.unlink(missing_ok=True)
+    async with client_scope(), javac_server_scope():
+        server = await asyncio.start_unix_server(_handle_connection, socket_path)
+        logging.getLogger(__name__).info(f"Serving on {socket_path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+async def send_request(socket_path: Path, cmd: str, argv: list[str]) -> tuple[int, str]:
+    """Sends a single request to a running daemon.
+
+    Args:
+        socket_path: Path of the daemon's Unix socket
+        cmd: The command to run, one of COMMANDS
+        argv: The command's arguments
+
+    Returns:
+        The invocation's exit code and logs
+    """
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        await _write_frame(writer, {"cmd": cmd, "args": argv, "cwd": os.getcwd()})
+        response = await _read_frame(reader)
+    finally:
+        writer.close()
+    if response is None:
+        raise ConnectionError("The daemon closed the connection without responding")
+    return response["exit_code"], response["output"]
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Runs the daemon, or forwards a single invocation to a running one."""
+    parser = argparse.ArgumentParser(
+        description="Long-lived nattyc daemon serving invocations over a Unix socket"
+    )
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        default=get_socket_path(),
+        help="Path of the daemon's Unix socket",
+    )
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    subparsers.add_parser("serve", help="Run the daemon")
+    client_parser = subparsers.add_parser(
+        "client", help="Forward a single invocation to a running daemon"
+    )
+    client_parser.add_argument("cmd", choices=sorted(COMMANDS))
+    client_parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    if args.mode == "serve":
+        try:
+            asyncio.run(serve(args.socket))
+        except KeyboardInterrupt:
+            pass
+    else:
+        exit_code, output = asyncio.run(send_request(args.socket, args.cmd, args.args))
+        sys.stderr.write(output)
+        sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,51 @@
 # //tools/rules_vibe/generate_usage_description.py
+import argparse
+import asyncio
+import functools
 import json
 import logging
 import os
+import re
 import sys
 from pathlib import Path
-from typing import cast
+from typing import IO, TYPE_CHECKING, NoReturn, cast
 
-import asyncclick as click
-from pydantic import BaseModel, Field
+from python.nattyc.logging_setup import setup_logging
 
-from python.nattyc.llm import call_llm
+if TYPE_CHECKING:
+    from pydantic import BaseModel
 
-
-class UsageDescription(BaseModel):
-    reasoning: str = Field(description="Use this field to plan out your solution.")
-    usage_description: str = Field(
-        description="The generated usage description for the provided code."
-    )
+# The most output tokens a batch asks for, however many files it describes. This is the most that
+# current Gemini models will generate for a single response.
+MAX_BATCH_OUTPUT_TOKENS = 65536
 
 
-def setup_logging(level: int = logging.INFO) -> None:
-    """Set up logging configuration.
+@functools.cache
+def _load_models() -> "tuple[type[BaseModel], type[BaseModel]]":
+    """Defines the pydantic response models, deferring the pydantic import until first use.
 
-    Args:
-        level: The logging level to use
+    Returns:
+        The UsageDescription and BatchUsage model classes
     """
-    logging.basicConfig(
-        level=level,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        handlers=[logging.StreamHandler(sys.stderr)],
-    )
+    from pydantic import BaseModel, Field
+
+    class UsageDescription(BaseModel):
+        reasoning: str = Field(description="Use this field to plan out your solution.")
+        usage_description: str = Field(
+            description="The generated usage description for the provided code."
+        )
+
+    class FileUsageDescription(UsageDescription):
+        file_name: str = Field(
+            description="The name of the source file that this usage description is for, exactly as given."
+        )
+
+    class BatchUsage(BaseModel):
+        items: list[FileUsageDescription] = Field(
+            description="One usage description for each of the provided source files."
+        )
+
+    return UsageDescription, BatchUsage
 
 
 def construct_system_prompt(source_code: str) -> str:
@@ -58,123 +74,372 @@ Here is the source code to describe:
 """
 
 
-@click.command(help="Generate usage descriptions for source code files")
-@click.option(
-    "--source_file",
-    type=click.Path(
-        exists=True,
-        file_okay=True,
-        dir_okay=False,
-        path_type=Path,
-        resolve_path=True,
-        readable=True,
-    ),
-    required=True,
-    help="Path to source code file",
-)
-@click.option(
-    "--output_file",
-    type=click.Path(
-        file_okay=True,
-        dir_okay=False,
-        path_type=Path,
-        resolve_path=True,
-        writable=True,
-    ),
-    required=True,
-    help="Path to output the usage description",
-)
-@click.option(
-    "--llm_model", required=True, help="LLM model name (e.g., gemini-2.0-flash-001)"
-)
-@click.option(
-    "--temperature", type=float, default=0.2, help="Sampling temperature (0.0-1.0)"
-)
-@click.option(
-    "--max_output_tokens", type=int, default=2048, help="Maximum output tokens"
-)
-@click.option(
-    "--api_key_env_var",
-    default="LLM_API_KEY",
-    help="Environment variable name for API key",
-)
-@click.option(
-    "--raw_header_file",
-    type=click.Path(
-        exists=True,
-        file_okay=True,
-        dir_okay=False,
-        path_type=Path,
-        resolve_path=True,
-        readable=True,
-    ),
-    required=True,
-    help="Path to raw header file to prepend to the output",
-)
-async def main(
+def construct_batch_system_prompt(source_codes: dict[str, str]) -> str:
+    """Constructs the system prompt for describing several source files in one LLM call.
+
+    Args:
+        source_codes: Dictionary mapping source file names to their code contents
+
+    Returns:
+        A formatted system prompt string for the LLM
+    """
+    files_section = "".join(
+        f'<FILE name="{name}">\n{content}\n</FILE>\n'
+        for name, content in source_codes.items()
+    )
+    return f"""You are a helpful assistant that generates clear, concise usage descriptions for source code.
+
+For EACH of the following given Java files, write a concise but effective usage guide in 300 words or less for consumption by an LLM (not a human).
+Start each guide by very briefly describing the purpose and intention of the class.
+
+CRITICAL: Only describe the PUBLIC interface of each class, do not describe any internal details unless they're absolutely essential for correct usage..
+CRITICAL: Clarify the semantic interpretation of any primitive arguments to public methods. The LLM should be able to understand what to pass in there, and WON'T HAVE ACCESS TO parameter names when they are given this code.
+CRITICAL: Return a JSON array with exactly one item per file, setting `file_name` to the exact name given in the corresponding FILE tag.
+
+
+Here are the source files to describe, each delimited by a FILE tag:
+
+{files_section}"""
+
+
+# Matches the parts of a usage description that need rewriting to embed it in a javadoc comment.
+_JAVADOC_ESCAPE_RE = re.compile(r"\n|\*/")
+
+
+def _escape_javadoc_match(match: re.Match[str]) -> str:
+    """Prefixes new lines with the javadoc '* ' margin and breaks up any premature '*/'."""
+    return "\n* " if match.group(0) == "\n" else "* /"
+
+
+def write_usage_description(
+    output_file: Path, usage_description: str, raw_header_file: Path
+) -> None:
+    """Writes the usage description as a javadoc comment followed by the raw header.
+
+    Args:
+        output_file: Path to write the formatted output to
+        usage_description: The usage description generated by the LLM
+        raw_header_file: Path to the raw header file to append after the javadoc comment
+    """
+    # Read the raw header file
+    raw_header_content = raw_header_file.read_text()
+
+    # Write as a javadoc comment first, then append the raw header content
+    with open(output_file, "w", buffering=1 << 16) as f:
+        f.write("/**\n* ")
+        f.write(_JAVADOC_ESCAPE_RE.sub(_escape_javadoc_match, usage_description))
+        f.write("\n*/\n")
+        f.write(raw_header_content)
+
+
+async def describe_single_file(
+    *,
     source_file: Path,
     output_file: Path,
+    raw_header_file: Path,
     llm_model: str,
+    api_key: str,
     temperature: float,
     max_output_tokens: int,
-    api_key_env_var: str,
-    raw_header_file: Path,
-) -> None:
-    """Main function to orchestrate the usage description generation process."""
-    # Set up logging
+    use_cache: bool,
+    cache_nondeterministic: bool,
+) -> dict[str, int | None]:
+    """Generates the usage description for a single source file.
+
+    Returns:
+        The usage stats reported for the LLM call
+    """
+    # Deferred so that argument parsing doesn't pay for importing pydantic or the Gemini SDK
+    from python.nattyc.llm_cache import cached_call_llm
+
+    UsageDescription, _ = _load_models()
+
+    # Read source code file
+    source_code = source_file.read_text()
+
+    # Construct the prompt
+    system_prompt = construct_system_prompt(source_code)
+
+    # Call the LLM
+    response = await cached_call_llm(
+        system_prompt=system_prompt,
+        english_description="Generate a usage description for the provided source code.",
+        model_name=llm_model,
+        api_key=api_key,
+        response_schema=UsageDescription,
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+        use_cache=use_cache,
+        cache_nondeterministic=cache_nondeterministic,
+    )
+
+    # Extract the usage description
+    usage_description = cast(UsageDescription, response.parsed).usage_description
+
+    write_usage_description(output_file, usage_description, raw_header_file)
+    return response.usage
+
+
+async def describe_batch(
+    *,
+    source_files: list[Path],
+    output_files: list[Path],
+    raw_header_files: list[Path],
+    llm_model: str,
+    api_key: str,
+    temperature: float,
+    max_output_tokens: int,
+    use_cache: bool,
+    cache_nondeterministic: bool,
+) -> dict[str, int | None]:
+    """Generates usage descriptions for several source files with a single LLM call.
+
+    Returns:
+        The usage stats reported for the LLM call
+    """
+    # Deferred so that argument parsing doesn't pay for importing pydantic or the Gemini SDK
+    from python.nattyc.llm_cache import cached_call_llm
+
+    _, BatchUsage = _load_models()
+
+    # Read all source code files, keyed by the name the LLM will echo back to us
+    source_codes = {
+        source_file.as_posix(): source_file.read_text() for source_file in source_files
+    }
+
+    # Construct the prompt
+    system_prompt = construct_batch_system_prompt(source_codes)
+
+    # Call the LLM. The output budget scales with the number of files being described, up to a
+    # fixed ceiling.
+    response = await cached_call_llm(
+        system_prompt=system_prompt,
+        english_description="Generate a usage description for each of the provided source files.",
+        model_name=llm_model,
+        api_key=api_key,
+        response_schema=BatchUsage,
+        temperature=temperature,
+        max_output_tokens=min(
+            max_output_tokens * len(source_files), MAX_BATCH_OUTPUT_TOKENS
+        ),
+        use_cache=use_cache,
+        cache_nondeterministic=cache_nondeterministic,
+    )
+
+    usage_descriptions = {
+        item.file_name: item.usage_description
+        for item in cast(BatchUsage, response.parsed).items
+    }
+    missing = [name for name in source_codes if name not in usage_descriptions]
+    if missing:
+        raise RuntimeError(
+            f"LLM response is missing usage descriptions for: {', '.join(missing)}"
+        )
+
+    for source_file, output_file, raw_header_file in zip(
+        source_files, output_files, raw_header_files
+    ):
+        write_usage_description(
+            output_file, usage_descriptions[source_file.as_posix()], raw_header_file
+        )
+    return response.usage
+
+
+def _existing_file(value: str) -> Path:
+    """argparse type for a path to an existing, readable file, resolved to an absolute path."""
+    path = Path(value).resolve()
+    if not path.is_file():
+        raise argparse.ArgumentTypeError(f"File '{value}' does not exist.")
+    if not os.access(path, os.R_OK):
+        raise argparse.ArgumentTypeError(f"File '{value}' is not readable.")
+    return path
+
+
+def _output_file(value: str) -> Path:
+    """argparse type for a path to an output file, resolved to an absolute path."""
+    path = Path(value).resolve()
+    if path.is_dir():
+        raise argparse.ArgumentTypeError(f"File '{value}' is a directory.")
+    return path
+
+
+class _LoggingArgumentParser(argparse.ArgumentParser):
+    """An ArgumentParser that reports usage errors and --help through logging.
+
+    argparse writes straight to stdout and stderr, which bypasses the per-request output captured
+    by a persistent worker (see daemon.py).
+    """
+
+    def print_help(self, file: IO[str] | None = None) -> None:
+        logging.getLogger(__name__).info(self.format_help())
+
+    def error(self, message: str) -> NoReturn:
+        logging.getLogger(__name__).error(
+            f"{self.format_usage()}{self.prog}: error: {message}"
+        )
+        self.exit(2)
+
+
+def _parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parses command line arguments.
+
+    This intentionally uses the stdlib argparse rather than asyncclick since this tool is invoked
+    once per Natty header and any startup overhead is multiplied across the whole build.
+
+    Args:
+        argv: The arguments to parse, defaults to sys.argv[1:]
+
+    Returns:
+        The parsed arguments
+    """
+    parser = _LoggingArgumentParser(
+        description="Generate usage descriptions for source code files"
+    )
+    parser.add_argument(
+        "--source_file",
+        action="append",
+        type=_existing_file,
+        required=True,
+        help="Path to source code file. May be repeated to describe several files in one LLM call.",
+    )
+    parser.add_argument(
+        "--output_file",
+        action="append",
+        type=_output_file,
+        required=True,
+        help="Path to output the usage description. Repeated once per --source_file, in the same order.",
+    )
+    parser.add_argument(
+        "--llm_model", required=True, help="LLM model name (e.g., gemini-2.0-flash-001)"
+    )
+    parser.add_argument(
+        "--temperature", type=float, default=0.2, help="Sampling temperature (0.0-1.0)"
+    )
+    parser.add_argument(
+        "--max_output_tokens", type=int, default=2048, help="Maximum output tokens"
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always call the LLM instead of reusing cached responses from $NATTYC_CACHE_DIR (default ~/.cache/nattyc).",
+    )
+    parser.add_argument(
+        "--cache_nondeterministic",
+        action="store_true",
+        help="Also cache LLM responses when the temperature is non-zero.",
+    )
+    parser.add_argument(
+        "--api_key_env_var",
+        default="LLM_API_KEY",
+        help="Environment variable name for API key",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Log LLM request metrics (e.g. rate limiting) to help tune LLM_MAX_CONCURRENCY.",
+    )
+    parser.add_argument(
+        "--raw_header_file",
+        action="append",
+        type=_existing_file,
+        required=True,
+        help="Path to raw header file to prepend to the output. Repeated once per --source_file, in the same order.",
+    )
+    return parser.parse_args(argv)
+
+
+async def _run(argv: list[str] | None = None) -> None:
+    """Orchestrates the usage description generation process.
+
+    Args:
+        argv: The command line arguments, defaults to sys.argv[1:]
+    """
+    # Set up logging first so that argument errors are reported through it
     setup_logging()
     logger = logging.getLogger(__name__)
+    args = _parse_args(argv)
 
     try:
-        # Read source code file
-        source_code = source_file.read_text()
-
-        # Construct the prompt
-        system_prompt = construct_system_prompt(source_code)
+        if not (
+            len(args.source_file) == len(args.output_file) == len(args.raw_header_file)
+        ):
+            logger.error(
+                "Error: --source_file, --output_file and --raw_header_file must be given the same number of times."
+            )
+            sys.exit(1)
 
         # Get API Key
-        api_key = os.environ.get(api_key_env_var)
+        api_key = os.environ.get(args.api_key_env_var)
         if not api_key:
-            logger.error(f"Error: {api_key_env_var} environment variable not set.")
+            logger.error(f"Error: {args.api_key_env_var} environment variable not set.")
             sys.exit(1)
 
-        # Call the LLM
-        response = await call_llm(
-            system_prompt=system_prompt,
-            english_description="Generate a usage description for the provided source code.",
-            model_name=llm_model,
-            api_key=api_key,
-            response_schema=UsageDescription,
-            temperature=temperature,
-            max_output_tokens=max_output_tokens,
-        )
+        from python.nattyc.llm import client_scope, log_metrics
 
-        # Extract the usage description
-        usage_description = cast(UsageDescription, response.parsed).usage_description
+        # Share one Gemini client (and its connections) across every call
+        async with client_scope():
+            if len(args.source_file) == 1:
+                usage = await describe_single_file(
+                    source_file=args.source_file[0],
+                    output_file=args.output_file[0],
+                    raw_header_file=args.raw_header_file[0],
+                    llm_model=args.llm_model,
+                    api_key=api_key,
+                    temperature=args.temperature,
+                    max_output_tokens=args.max_output_tokens,
+                    use_cache=not args.no_cache,
+                    cache_nondeterministic=args.cache_nondeterministic,
+                )
+            else:
+                usage = await describe_batch(
+                    source_files=args.source_file,
+                    output_files=args.output_file,
+                    raw_header_files=args.raw_header_file,
+                    llm_model=args.llm_model,
+                    api_key=api_key,
+                    temperature=args.temperature,
+                    max_output_tokens=args.max_output_tokens,
+                    use_cache=not args.no_cache,
+                    cache_nondeterministic=args.cache_nondeterministic,
+                )
 
-        # Read the raw header file
-        raw_header_content = raw_header_file.read_text()
-
-        # Format as a javadoc comment first, then append the raw header content
-        javadoc_comment = (
-            "/**\n* "
-            + usage_description.replace("\n", "\n* ").replace("*/", "* /")
-            + "\n*/\n"
-        )
-        formatted_output = javadoc_comment + raw_header_content
-
-        # Write the output
-        with open(output_file, "w") as f:
-            f.write(formatted_output)
+        if args.verbose:
+            log_metrics()
 
         # Log success message with usage stats
-        logger.info(f"Successfully generated usage description at {output_file}")
-        logger.info(f"Usage stats: {json.dumps(response.usage)}")
+        for f in args.output_file:
+            logger.info(f"Successfully generated usage description at {f}")
+        logger.info(f"Usage stats: {json.dumps(usage)}")
 
     except Exception as e:
         logger.error(f"Error: {str(e)}")
         sys.exit(1)
 
 
+async def run(argv: list[str]) -> int:
+    """Runs the CLI in-process, returning its exit code rather than exiting.
+
+    This lets long-lived processes (see daemon.py) handle many invocations.
+
+    Args:
+        argv: The command line arguments, excluding the program name
+
+    Returns:
+        The exit code of the invocation
+    """
+    try:
+        await _run(argv)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    return 0
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Main function to orchestrate the usage description generation process."""
+    asyncio.run(_run(argv))
+
+
 if __name__ == "__main__":
-    main()
+    from python.nattyc.daemon import run_cli
+
+    run_cli(main, run)
@@ -0,0 +1,175 @@
+import asyncio
+import contextlib
+import logging
+import struct
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass
+class CompileResult:
+    """Data class to hold the result of a JavacServer compilation."""
+
+    success: bool
+    output: str
+
+
+class JavacServerError(RuntimeError):
+    """Raised when the JavacServer sidecar can't be started or stops responding."""
+
+
+class JavacServer:
+    """Client for the long-lived //java/com/natty/javac:javac_server sidecar.
+
+    The sidecar keeps a single JVM (and javac instance) warm for the lifetime of this process so
+    that repeated validations don't each pay JVM startup. See JavacServer.java for the protocol.
+    """
+
+    def __init__(self, process: asyncio.subprocess.Process) -> None:
+        self._process = process
+        # Requests and responses are not tagged, so only one may be in flight at a time.
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def start(cls, executable: Path) -> "JavacServer":
+        """Starts the sidecar process.
+
+        Args:
+            executable: Path to the javac_server binary
+
+        Returns:
+            A client connected to the newly started sidecar
+
+        Raises:
+            JavacServerError: If the sidecar process could not be started
+        """
+        try:
+            process = await asyncio.create_subprocess_exec(
+                executable.as_posix(),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            raise JavacServerError(f"Failed to start javac server: {str(e)}") from e
+        return cls(process)
+
+    async def compile(
+        self, sources: dict[str, str], classpath: list[Path]
+    ) -> CompileResult:
+        """Compiles the given Java sources in-memory.
+
+        Args:
+            sources: Dictionary mapping Java file names (e.g. Foo.java) to their source code
+            classpath: Jar files needed on the classpath for compilation
+
+        Returns:
+            CompileResult containing whether compilation succeeded and the compiler output
+
+        Raises:
+            JavacServerError: If the sidecar has exited or sent a malformed response
+        """
+        assert self._process.stdin and self._process.stdout
+        request = _encode_str(":".join(jar.as_posix() for jar in classpath))
+        request += struct.pack(">i", len(sources))
+        for file_name, source in sources.items():
+            request += _encode_str(file_name) + _encode_str(source)
+
+        async with self._lock:
+            try:
+                self._process.stdin.write(request)
+                await self._process.stdin.drain()
+                success = await self._process.stdout.readexactly(1)
+                (output_len,) = struct.unpack(
+                    ">i", await self._process.stdout.readexactly(4)
+                )
+                output = await self._process.stdout.readexactly(output_len)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                raise JavacServerError(
+                    f"javac server stopped responding: {str(e)}"
+                ) from e
+
+        return CompileResult(success=success != b"\x00", output=output.decode())
+
+    async def close(self) -> None:
+        """Shuts down the sidecar by closing its stdin and waiting for it to exit."""
+        if self._process.returncode is None:
+            assert self._process.stdin
+            self._process.stdin.close()
+        await self._process.wait()
+
+    async def kill(self) -> None:
+        """Forcibly stops the sidecar, e.g. after it stopped responding."""
+        if self._process.returncode is None:
+            self._process.kill()
+        await self._process.wait()
+
+
+def _encode_str(s: str) -> bytes:
+    """Encodes a string as a length-prefixed UTF-8 frame."""
+    data = s.encode()
+    return struct.pack(">i", len(data)) + data
+
+
+_server: JavacServer | None = None
+_server_failed = False
+_server_lock = asyncio.Lock()
+# How many javac_server_scopes are currently open, only the outermost one shuts the server down.
+_server_scope_depth = 0
+
+
+async def get_javac_server(executable: Path) -> JavacServer | None:
+    """Lazily starts the process-wide JavacServer.
+
+    Args:
+        executable: Path to the javac_server binary
+
+    Returns:
+        The shared JavacServer, or None if it can't be started and callers should fall back to
+        spawning javac directly
+    """
+    global _server, _server_failed
+    async with _server_lock:
+        if _server is None and not _server_failed:
+            try:
+                _server = await JavacServer.start(executable)
+            except JavacServerError as e:
+                logging.warning(f"{str(e)}. Falling back to javac subprocesses.")
+                _server_failed = True
+        return _server
+
+
+async def discard_javac_server() -> None:
+    """Shuts down the shared JavacServer, if any, and stops future attempts to restart it."""
+    global _server, _server_failed
+    async with _server_lock:
+        if _server is not None:
+            await _server.kill()
+            _server = None
+        _server_failed = True
+
+
+async def shutdown_javac_server() -> None:
+    """Shuts down the shared JavacServer, if one was started."""
+    global _server
+    async with _server_lock:
+        if _server is not None:
+            await _server.close()
+            _server = None
+
+
+@contextlib.asynccontextmanager
+async def javac_server_scope() -> AsyncIterator[None]:
+    """Context manager that shuts down the shared JavacServer once all validations are done.
+
+    Scopes may nest, e.g. a long-lived daemon keeps the server running across the many
+    invocations it handles.
+    """
+    global _server_scope_depth
+    _server_scope_depth += 1
+    try:
+        yield
+    finally:
+        _server_scope_depth -= 1
+        if not _server_scope_depth:
+            await shutdown_javac_server()
@@ -1,18 +1,71 @@
+import asyncio
+import contextlib
+import functools
 import logging
+import os
+import random
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable, Sequence
 from dataclasses import dataclass
-from typing import cast
+from typing import Any, Literal, TypeVar
 
+import httpx
 from google import genai
+from google.genai import errors
 from google.genai.types import (
+    Content,
+    CreateCachedContentConfig,
     GenerateContentConfig,
+    GenerateContentResponse,
     HarmBlockThreshold,
     HarmCategory,
+    HttpOptions,
+    Part,
     SafetySetting,
 )
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
+# How much new response text call_llm_stream waits for between calls to check_partial.
+PARTIAL_CHECK_INTERVAL_CHARS = 1024
 
-@dataclass
+
+def _max_concurrency() -> int:
+    """Reads the request concurrency limit from $LLM_MAX_CONCURRENCY, defaulting to 8."""
+    value = os.environ.get("LLM_MAX_CONCURRENCY", "8")
+    try:
+        if (max_concurrency := int(value)) >= 1:
+            return max_concurrency
+    except ValueError:
+        pass
+    raise ValueError(
+        f"LLM_MAX_CONCURRENCY must be a positive integer, but it was set to {value!r}."
+    )
+
+
+# Caps the number of LLM requests in flight at once across this process, so that speculative
+# samples, batches and daemon requests don't together thrash the provider's rate limits.
+MAX_CONCURRENCY = _max_concurrency()
+_request_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# How many times a rate limited (HTTP 429) request is retried before giving up.
+MAX_RATE_LIMIT_RETRIES = 5
+
+# How many times a request that timed out or hit a transient server error (HTTP 5xx) is retried
+# before giving up.
+MAX_TRANSIENT_RETRIES = 2
+
+T = TypeVar("T")
+
+# Only block content with a high probability of being harmful, so that code generation isn't
+# tripped up by false positives. These never change, so they're built once rather than per request.
+_SAFETY_SETTINGS = tuple(
+    SafetySetting(category=category, threshold=HarmBlockThreshold.BLOCK_ONLY_HIGH)
+    for category in HarmCategory
+    if category is not HarmCategory.HARM_CATEGORY_UNSPECIFIED
+)
+
+
+@dataclass(slots=True)
 class LlmResponse:
     """Data class to standardize LLM response format."""
 
@@ -22,6 +75,211 @@ class LlmResponse:
     finish_reason: str | None
 
 
+@dataclass(frozen=True, slots=True)
+class ChatMessage:
+    """A single turn of a multi-turn conversation with the LLM."""
+
+    role: Literal["user", "model"]
+    text: str
+
+
+class LlmStreamAborted(RuntimeError):
+    """Raised when call_llm_stream abandons a response that was rejected part way through."""
+
+    def __init__(self, error_message: str, partial_text: str) -> None:
+        super().__init__(error_message)
+        self.error_message = error_message
+        self.partial_text = partial_text
+
+
+class ContextCacheRefused(RuntimeError):
+    """Raised when Gemini refuses to cache a prompt, e.g. because it's below the model's minimum."""
+
+
+@dataclass
+class LlmMetrics:
+    """Counters describing the LLM requests made by this process."""
+
+    requests: int = 0
+    in_flight: int = 0
+    peak_in_flight: int = 0
+    rate_limited: int = 0
+    transient_errors: int = 0
+
+
+metrics = LlmMetrics()
+
+
+def log_metrics() -> None:
+    """Logs the LLM request metrics, to help tune LLM_MAX_CONCURRENCY."""
+    logging.getLogger(__name__).info(
+        f"LLM requests: {metrics.requests}, "
+        f"peak in flight: {metrics.peak_in_flight}/{MAX_CONCURRENCY}, "
+        f"rate limited: {metrics.rate_limited}, "
+        f"transient errors: {metrics.transient_errors}"
+    )
+
+
+@contextlib.asynccontextmanager
+async def _request_slot() -> AsyncIterator[None]:
+    """Holds one of the MAX_CONCURRENCY request slots, waiting for one to free up if needed."""
+    async with _request_semaphore:
+        metrics.requests += 1
+        metrics.in_flight += 1
+        metrics.peak_in_flight = max(metrics.peak_in_flight, metrics.in_flight)
+        try:
+            yield
+        finally:
+            metrics.in_flight -= 1
+
+
+def _retry_after_seconds(e: errors.APIError) -> float | None:
+    """Returns the delay requested by a rate limited response's Retry-After header, if any."""
+    if not isinstance(e.response, httpx.Response):
+        return None
+    try:
+        return float(e.response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _is_transient(e: Exception) -> bool:
+    """Returns whether a failed request may succeed if it's simply sent again."""
+    if isinstance(e, errors.APIError):
+        return e.code in (500, 502, 503, 504)
+    return isinstance(e, (httpx.TimeoutException, httpx.NetworkError))
+
+
+async def _retry_transient_errors(send: Callable[[], Awaitable[T]]) -> T:
+    """Sends a request, retrying with jittered exponential backoff on transient failures.
+
+    Rate limited requests are retried up to MAX_RATE_LIMIT_RETRIES times, and requests that timed
+    out or hit a transient server error up to MAX_TRANSIENT_RETRIES times. Anything else fails
+    immediately.
+
+    Args:
+        send: Sends the request
+
+    Returns:
+        The result of the first request that succeeded
+    """
+    rate_limit_retries = transient_retries = 0
+    while True:
+        try:
+            return await send()
+        except Exception as e:
+            if isinstance(e, errors.APIError) and e.code == 429:
+                if rate_limit_retries == MAX_RATE_LIMIT_RETRIES:
+                    raise
+                metrics.rate_limited += 1
+                delay = _retry_after_seconds(e) or 2**rate_limit_retries
+                rate_limit_retries += 1
+                reason = "was rate limited"
+            elif _is_transient(e):
+                if transient_retries == MAX_TRANSIENT_RETRIES:
+                    raise
+                metrics.transient_errors += 1
+                delay = 2**transient_retries
+                transient_retries += 1
+                reason = f"failed ({type(e).__name__}: {str(e)})"
+            else:
+                raise
+        delay *= random.uniform(1, 1.5)
+        logging.getLogger(__name__).warning(
+            f"LLM request {reason}, retrying in {delay:.1f}s"
+        )
+        # The request slot is deliberately held while waiting, which throttles this process
+        # for as long as the provider is pushing back.
+        await asyncio.sleep(delay)
+
+
+async def _retry_transient_errors_in_stream(
+    open_stream: Callable[[], Awaitable[AsyncIterator[T]]],
+) -> AsyncIterator[T]:
+    """Opens a stream like _retry_transient_errors sends a request, retrying transient failures.
+
+    google-genai only sends a streaming request once the first chunk is awaited, so that's what
+    has to be retried rather than just the call that creates the stream.
+
+    Args:
+        open_stream: Creates the stream
+
+    Returns:
+        The stream, starting from its first chunk
+    """
+
+    async def start() -> tuple[AsyncIterator[T], list[T]]:
+        stream = await open_stream()
+        try:
+            return stream, [await anext(stream)]
+        except StopAsyncIteration:
+            return stream, []
+
+    stream, first_chunks = await _retry_transient_errors(start)
+
+    async def resume() -> AsyncIterator[T]:
+        for chunk in first_chunks:
+            yield chunk
+        async for chunk in stream:
+            yield chunk
+
+    return resume()
+
+
+# Gemini clients shared by every call in this process, keyed by API key. Each client owns an
+# HTTP connection pool, so reusing them avoids a new TCP+TLS handshake per call.
+_clients: dict[str, genai.Client] = {}
+
+
+def get_client(api_key: str) -> genai.Client:
+    """Returns the shared Gemini client for api_key, creating it on first use.
+
+    Args:
+        api_key: API key for authentication
+
+    Returns:
+        The shared client
+    """
+    client = _clients.get(api_key)
+    if client is None:
+        client = genai.Client(
+            api_key=api_key,
+            http_options=HttpOptions(
+                async_client_args={"limits": httpx.Limits(max_keepalive_connections=32)}
+            ),
+        )
+        _clients[api_key] = client
+    return client
+
+
+async def close_clients() -> None:
+    """Closes the HTTP connections held by the shared Gemini clients."""
+    for client in _clients.values():
+        # google-genai doesn't expose a way to close its async HTTP client
+        async_httpx_client = getattr(client._api_client, "_async_httpx_client", None)
+        if async_httpx_client is not None:
+            await async_httpx_client.aclose()
+    _clients.clear()
+
+
+# How many client_scopes are currently open. Scopes may nest (e.g. a long-lived daemon handling
+# many invocations), and only the outermost one closes the clients.
+_client_scope_depth = 0
+
+
+@contextlib.asynccontextmanager
+async def client_scope() -> AsyncIterator[None]:
+    """Context manager that closes the shared Gemini clients once all LLM calls are done."""
+    global _client_scope_depth
+    _client_scope_depth += 1
+    try:
+        yield
+    finally:
+        _client_scope_depth -= 1
+        if not _client_scope_depth:
+            await close_clients()
+
+
 async def call_llm(
     *,
     system_prompt: str,
@@ -31,6 +289,8 @@ async def call_llm(
     response_schema: type[BaseModel],
     temperature: float = 0.2,
     max_output_tokens: int = 8192,
+    follow_up_messages: Sequence[ChatMessage] = (),
+    cached_content: str | None = None,
 ) -> LlmResponse:
     """Call the Gemini API to generate code.
 
@@ -40,6 +300,10 @@ async def call_llm(
         api_key: API key for authentication
         temperature: Sampling temperature (lower = more deterministic)
         max_output_tokens: Maximum tokens in the response
+        follow_up_messages: Conversation turns to send after english_description, e.g. a
+            rejected response and the feedback on it
+        cached_content: Name of a context cache (see create_context_cache) holding the start of
+            the system prompt, in which case system_prompt is only the remainder
 
     Returns:
         An LlmResponse object containing the generated code and metadata
@@ -60,62 +324,370 @@ async def call_llm(
         raise ValueError("Error: LLM_API_KEY not set.")
 
     try:
-        # Create a client instance
-        client = genai.Client(api_key=api_key)
+        # Reuse the shared client (and its open connections) across calls
+        client = get_client(api_key)
 
         # Generate the content
-        response = await client.aio.models.generate_content(
-            model=model_name,
-            contents=english_description,
-            config=GenerateContentConfig(
-                system_instruction=system_prompt,
-                candidate_count=1,
-                temperature=temperature,
-                max_output_tokens=max_output_tokens,
-                # Set up safety settings - allow code generation
-                safety_settings=[
-                    SafetySetting(
-                        category=category,
-                        threshold=HarmBlockThreshold.BLOCK_ONLY_HIGH,
-                    )
-                    for category in HarmCategory
-                    if category is not HarmCategory.HARM_CATEGORY_UNSPECIFIED
-                ],
-                response_mime_type="application/json",
-                response_schema=response_schema,
-            ),
-        )
+        async with _request_slot():
+            response = await _retry_transient_errors(
+                lambda: client.aio.models.generate_content(
+                    model=model_name,
+                    contents=_contents(
+                        english_description,
+                        follow_up_messages,
+                        # A cached system instruction can't be combined with another one, so the
+                        # rest of the system prompt leads the conversation instead
+                        preamble=system_prompt if cached_content else "",
+                    ),
+                    config=_generate_content_config(
+                        system_prompt=system_prompt,
+                        cached_content=cached_content,
+                        response_schema=response_schema,
+                        temperature=temperature,
+                        max_output_tokens=max_output_tokens,
+                    ),
+                )
+            )
 
         # Handle potential content filtering
         if response.candidates and response.candidates[0].finish_reason == "SAFETY":
             raise RuntimeError("Content was filtered due to safety concerns")
 
-        if not response.parsed:
-            raise RuntimeError("LLM Response failed to parse to required schema.")
-
-        # Create usage stats dictionary (estimate, as Gemini might not provide exact counts)
-        if response.usage_metadata:
-            usage = {
-                "input_tokens": response.usage_metadata.prompt_token_count,
-                "completion_tokens": response.usage_metadata.candidates_token_count,
-                "cached_tokens": response.usage_metadata.cached_content_token_count,
-                "total_tokens": response.usage_metadata.total_token_count,
-            }
-        else:
-            usage = {}
-
         # Get finish reason
         finish_reason = None
         if response.candidates:
             finish_reason = response.candidates[0].finish_reason
 
+        text = response.text or ""
+        return LlmResponse(
+            parsed=_parse_response(text, response_schema),
+            model=model_name,
+            usage=_usage_stats(
+                response,
+                prompt=(
+                    system_prompt,
+                    english_description,
+                    *(message.text for message in follow_up_messages),
+                ),
+                text=text,
+            ),
+            finish_reason=finish_reason,
+        )
+
+    except Exception as e:
+        logger.error(f"Error calling Gemini API: {str(e)}")
+        raise RuntimeError(f"Failed to generate code: {str(e)}") from e
+
+
+async def call_llm_stream(
+    *,
+    system_prompt: str,
+    english_description: str,
+    model_name: str,
+    api_key: str,
+    response_schema: type[BaseModel],
+    check_partial: Callable[[str], str | None],
+    temperature: float = 0.2,
+    max_output_tokens: int = 8192,
+    follow_up_messages: Sequence[ChatMessage] = (),
+    cached_content: str | None = None,
+) -> LlmResponse:
+    """Call the Gemini API to generate code, streaming the response as it's generated.
+
+    This behaves like call_llm, except that check_partial is periodically given the raw response
+    text received so far, so that obviously broken responses can be abandoned early instead of
+    waiting for (and paying for) the rest of the generation.
+
+    Args:
+        system_prompt: The system prompt to send to the LLM
+        english_description: The user message to send to the LLM
+        model_name: The specific Gemini model to use
+        api_key: API key for authentication
+        response_schema: The pydantic model the response must conform to
+        check_partial: Given the raw response text so far, returns an error message if the
+            response should be abandoned, or None to keep going
+        temperature: Sampling temperature (lower = more deterministic)
+        max_output_tokens: Maximum tokens in the response
+        follow_up_messages: Conversation turns to send after english_description
+        cached_content: Name of a context cache holding the start of the system prompt
+
+    Returns:
+        An LlmResponse object containing the generated code and metadata
+
+    Raises:
+        ValueError: If required parameters are missing or invalid
+        LlmStreamAborted: If check_partial rejected the response
+        RuntimeError: If the API call fails
+    """
+    logger = logging.getLogger(__name__)
+
+    logger.debug(f"--- SYSTEM PROMPT for {model_name} ---")
+    logger.debug(system_prompt)
+    logger.debug("--- END SYSTEM PROMPT ---")
+
+    if not api_key:
+        raise ValueError("Error: LLM_API_KEY not set.")
+
+    try:
+        # Reuse the shared client (and its open connections) across calls
+        client = get_client(api_key)
+
+        text_parts: list[str] = []
+        unchecked_chars = 0
+        last_chunk = None
+        # The request slot is held until the whole response has been streamed
+        async with _request_slot():
+            stream = await _retry_transient_errors_in_stream(
+                lambda: client.aio.models.generate_content_stream(
+                    model=model_name,
+                    contents=_contents(
+                        english_description,
+                        follow_up_messages,
+                        # A cached system instruction can't be combined with another one, so the
+                        # rest of the system prompt leads the conversation instead
+                        preamble=system_prompt if cached_content else "",
+                    ),
+                    config=_generate_content_config(
+                        system_prompt=system_prompt,
+                        cached_content=cached_content,
+                        response_schema=response_schema,
+                        temperature=temperature,
+                        max_output_tokens=max_output_tokens,
+                    ),
+                )
+            )
+            async for chunk in stream:
+                last_chunk = chunk
+                if not chunk.text:
+                    continue
+                text_parts.append(chunk.text)
+                unchecked_chars += len(chunk.text)
+
+                # Only check every so often, each check re-examines the whole response so far
+                if unchecked_chars >= PARTIAL_CHECK_INTERVAL_CHARS:
+                    unchecked_chars = 0
+                    partial_text = "".join(text_parts)
+                    error_message = check_partial(partial_text)
+                    if error_message:
+                        raise LlmStreamAborted(error_message, partial_text)
+
+        # Handle potential content filtering
+        finish_reason = None
+        if last_chunk and last_chunk.candidates:
+            finish_reason = last_chunk.candidates[0].finish_reason
+        if finish_reason == "SAFETY":
+            raise RuntimeError("Content was filtered due to safety concerns")
+
+        text = "".join(text_parts)
         return LlmResponse(
-            parsed=cast(BaseModel, response.parsed),
+            parsed=_parse_response(text, response_schema),
             model=model_name,
-            usage=usage,
+            usage=_usage_stats(
+                last_chunk,
+                prompt=(
+                    system_prompt,
+                    english_description,
+                    *(message.text for message in follow_up_messages),
+                ),
+                text=text,
+            ),
             finish_reason=finish_reason,
         )
 
+    except LlmStreamAborted:
+        raise
     except Exception as e:
         logger.error(f"Error calling Gemini API: {str(e)}")
-        raise RuntimeError(f"Failed to generate code: {str(e)}")
+        raise RuntimeError(f"Failed to generate code: {str(e)}") from e
+
+
+async def create_context_cache(
+    *, system_prompt: str, model_name: str, api_key: str, ttl_seconds: int
+) -> tuple[str, float]:
+    """Uploads a system prompt to Gemini's context cache so later requests can reference it.
+
+    Args:
+        system_prompt: The system prompt to cache
+        model_name: The specific Gemini model the cache will be used with
+        api_key: API key for authentication
+        ttl_seconds: How long the provider should keep the cache around
+
+    Returns:
+        The cache's name, to pass as cached_content, and its expiry as a Unix timestamp
+
+    Raises:
+        ContextCacheRefused: If Gemini won't cache the prompt, e.g. because it's below the model's
+            minimum cacheable size
+        google.genai.errors.APIError: If the cache couldn't be created for any other reason
+    """
+    client = get_client(api_key)
+    async with _request_slot():
+        try:
+            cached_content = await _retry_transient_errors(
+                lambda: client.aio.caches.create(
+                    model=model_name,
+                    config=CreateCachedContentConfig(
+                        system_instruction=system_prompt, ttl=f"{ttl_seconds}s"
+                    ),
+                )
+            )
+        except errors.APIError as e:
+            if e.code == 400:
+                raise ContextCacheRefused(str(e)) from e
+            raise
+    if not cached_content.name:
+        raise RuntimeError("Context cache was created without a name")
+    if cached_content.expire_time:
+        expire_time = cached_content.expire_time.timestamp()
+    else:
+        expire_time = time.time() + ttl_seconds
+    return cached_content.name, expire_time
+
+
+def is_context_cache_error(e: BaseException) -> bool:
+    """Returns whether an LLM call failed because its context cache is gone or unusable.
+
+    Args:
+        e: The exception raised by call_llm or call_llm_stream
+
+    Returns:
+        True if the provider rejected the request's cached content (e.g. because it expired or was
+        evicted early), in which case the request may succeed without it
+    """
+    cause: BaseException | None = e
+    while cause is not None:
+        if (
+            isinstance(cause, errors.APIError)
+            and cause.code in (400, 403, 404)
+            and "cachedcontent" in str(cause).lower().replace(" ", "")
+        ):
+            return True
+        cause = cause.__cause__
+    return False
+
+
+def _contents(
+    english_description: str,
+    follow_up_messages: Sequence[ChatMessage],
+    preamble: str = "",
+) -> str | list[Content]:
+    """Builds the request contents from the user message and any follow-up turns.
+
+    Args:
+        english_description: The user message
+        follow_up_messages: Conversation turns to send after english_description
+        preamble: Text to send ahead of english_description in the same turn, if any
+    """
+    if not follow_up_messages and not preamble:
+        return english_description
+    first_message = Content(
+        role="user",
+        parts=[Part(text=text) for text in (preamble, english_description) if text],
+    )
+    return [
+        first_message,
+        *(
+            Content(role=message.role, parts=[Part(text=message.text)])
+            for message in follow_up_messages
+        ),
+    ]
+
+
+def _generate_content_config(
+    *,
+    system_prompt: str,
+    cached_content: str | None,
+    response_schema: type[BaseModel],
+    temperature: float,
+    max_output_tokens: int,
+) -> GenerateContentConfig:
+    """Builds the request config shared by call_llm and call_llm_stream."""
+    return GenerateContentConfig(
+        # The system instruction is part of the cached content when there is one
+        system_instruction=None if cached_content else system_prompt,
+        cached_content=cached_content,
+        candidate_count=1,
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+        safety_settings=_SAFETY_SETTINGS,
+        response_mime_type="application/json",
+        response_schema=response_json_schema(response_schema),
+    )
+
+
+@functools.cache
+def response_json_schema(response_schema: type[BaseModel]) -> dict[str, Any]:
+    """Returns the JSON schema responses are constrained to, computed once per model.
+
+    Given a pydantic class, the SDK regenerates its schema on every request. A prebuilt dict skips
+    that, and the response is parsed by _parse_response instead.
+    """
+    schema = response_schema.model_json_schema()
+    _add_property_ordering(schema)
+    return schema
+
+
+def _add_property_ordering(schema: Any) -> None:
+    """Pins the order of every object's properties to their declaration order.
+
+    The SDK does this itself for pydantic classes. It matters because fields like reasoning must
+    be generated before the code they reason about.
+    """
+    if isinstance(schema, dict):
+        if isinstance(schema.get("properties"), dict):
+            schema["property_ordering"] = list(schema["properties"])
+        for value in schema.values():
+            _add_property_ordering(value)
+    elif isinstance(schema, list):
+        for value in schema:
+            _add_property_ordering(value)
+
+
+def _parse_response(text: str, response_schema: type[BaseModel]) -> BaseModel:
+    """Parses a response's JSON text into response_schema.
+
+    pydantic parses and validates the raw JSON in one native pass, which is faster than going via
+    json.loads.
+
+    Raises:
+        RuntimeError: If the text doesn't conform to response_schema
+    """
+    try:
+        return response_schema.model_validate_json(text)
+    except ValidationError:
+        raise RuntimeError("LLM Response failed to parse to required schema.")
+
+
+def _usage_stats(
+    response: GenerateContentResponse | None,
+    *,
+    prompt: Sequence[str],
+    text: str,
+) -> dict[str, int | None]:
+    """Extracts usage stats from a Gemini response (or the final chunk of a streamed one).
+
+    Args:
+        response: The response, or None if nothing was received
+        prompt: The parts of the prompt that was sent, only used when the response has no usage
+            metadata
+        text: The response text, only used when the response has no usage metadata
+
+    Returns:
+        Token counts as reported by Gemini, or estimated at ~4 bytes of UTF-8 per token if Gemini
+        didn't report them
+    """
+    if response and response.usage_metadata:
+        return {
+            "input_tokens": response.usage_metadata.prompt_token_count,
+            "completion_tokens": response.usage_metadata.candidates_token_count,
+            "cached_tokens": response.usage_metadata.cached_content_token_count,
+            "total_tokens": response.usage_metadata.total_token_count,
+        }
+    input_tokens = sum(len(part.encode()) for part in prompt) // 4
+    completion_tokens = len(text.encode()) // 4
+    return {
+        "input_tokens": input_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": None,
+        "total_tokens": input_tokens + completion_tokens,
+    }
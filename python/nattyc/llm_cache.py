@@ -0,0 +1,388 @@
+import asyncio
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections.abc import AsyncIterator, Callable, Sequence
+from pathlib import Path
+
+import pydantic_core
+from pydantic import BaseModel, ValidationError
+
+from python.nattyc.llm import (
+    ChatMessage,
+    ContextCacheRefused,
+    LlmResponse,
+    call_llm,
+    call_llm_stream,
+    create_context_cache,
+    is_context_cache_error,
+)
+
+# Gemini refuses to cache prompts below a model-specific minimum of roughly 1024-4096 tokens, so
+# prompts clearly under that (at ~4 chars per token) aren't worth a round trip to find out.
+MIN_CONTEXT_CACHE_CHARS = 4 * 1024
+
+# Context caches this close to expiring are treated as already gone.
+CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS = 60
+
+# Prompts the provider refused to cache (e.g. for being below the model's minimum size) are
+# recorded in the index for this long, so that other processes don't keep asking either.
+UNCACHEABLE_PROMPT_RECHECK_SECONDS = 24 * 60 * 60
+
+_context_cache_lock = asyncio.Lock()
+# Keys of prompts that couldn't be cached, so that this process doesn't keep asking.
+_uncacheable_prompts: set[str] = set()
+
+
+def get_cache_dir() -> Path:
+    """Returns the directory LLM responses are cached in.
+
+    Defaults to ~/.cache/nattyc, and can be overridden via the NATTYC_CACHE_DIR env var.
+    """
+    cache_dir = os.environ.get("NATTYC_CACHE_DIR")
+    if cache_dir:
+        return Path(cache_dir)
+    return Path.home() / ".cache" / "nattyc"
+
+
+def compute_cache_key(
+    *,
+    system_prompt: str,
+    english_description: str,
+    model_name: str,
+    response_schema: type[BaseModel],
+    temperature: float,
+    max_output_tokens: int,
+    follow_up_messages: Sequence[ChatMessage] = (),
+) -> str:
+    """Computes a content-addressed key for an LLM request.
+
+    Returns:
+        Hex-encoded SHA256 over every input that can affect the LLM response
+    """
+    return _hash_parts(
+        model_name,
+        repr(temperature),
+        repr(max_output_tokens),
+        _canonical_schema(response_schema),
+        system_prompt,
+        english_description,
+        *(
+            part
+            for message in follow_up_messages
+            for part in (message.role, message.text)
+        ),
+    )
+
+
+@functools.cache
+def _canonical_schema(response_schema: type[BaseModel]) -> str:
+    """Returns the canonical JSON of a response schema, generated once per model."""
+    return json.dumps(response_schema.model_json_schema(), sort_keys=True)
+
+
+def _hash_parts(*parts: str) -> str:
+    """Returns the hex-encoded SHA256 of a sequence of strings."""
+    h = hashlib.sha256()
+    for part in parts:
+        data = part.encode()
+        # Length-prefix each part so that different splits of the same bytes can't collide
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _read_cached_response(
+    cache_file: Path, response_schema: type[BaseModel]
+) -> LlmResponse | None:
+    """Reads a cached LlmResponse, returning None on a miss or an unreadable entry."""
+    try:
+        entry = pydantic_core.from_json(cache_file.read_bytes())
+        return LlmResponse(
+            parsed=response_schema.model_validate(entry["parsed"]),
+            model=entry["model"],
+            usage=entry["usage"],
+            finish_reason=entry["finish_reason"],
+        )
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, ValidationError) as e:
+        logging.getLogger(__name__).warning(
+            f"Ignoring corrupt LLM cache entry {cache_file}: {str(e)}"
+        )
+        return None
+
+
+def _write_cached_response(cache_file: Path, response: LlmResponse) -> None:
+    """Atomically writes an LlmResponse to the cache."""
+    entry = {
+        "parsed": response.parsed.model_dump(mode="json"),
+        "model": response.model,
+        "usage": response.usage,
+        "finish_reason": response.finish_reason,
+    }
+    _write_json_atomically(cache_file, entry)
+
+
+def _write_json_atomically(path: Path, value: object) -> None:
+    """Writes value to path as JSON, such that readers never see a partial file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temp file in the same directory so that the final rename is atomic
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(pydantic_core.to_json(value))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _read_context_cache_index() -> dict[str, dict]:
+    """Reads the index of live context caches, keyed by the hash of the prompt they hold."""
+    index_file = get_cache_dir() / "context_caches.json"
+    try:
+        index = pydantic_core.from_json(index_file.read_bytes())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.getLogger(__name__).warning(
+            f"Ignoring corrupt context cache index {index_file}: {str(e)}"
+        )
+        return {}
+    # Drop expired entries as we go so that the index doesn't grow forever
+    cutoff = time.time() + CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS
+    return {
+        key: entry
+        for key, entry in index.items()
+        if isinstance(entry, dict) and entry.get("expire_time", 0) > cutoff
+    }
+
+
+def _write_context_cache_index(index: dict[str, dict]) -> None:
+    """Writes the index of live context caches, which is purely an optimization."""
+    index_file = get_cache_dir() / "context_caches.json"
+    try:
+        _write_json_atomically(index_file, index)
+    except OSError as e:
+        logging.getLogger(__name__).warning(
+            f"Failed to write context cache index {index_file}: {str(e)}"
+        )
+
+
+@contextlib.asynccontextmanager
+async def _context_cache_index_lock() -> AsyncIterator[None]:
+    """Holds the lock on the context cache index, which every process using it shares."""
+    async with _context_cache_lock:
+        lock_file = get_cache_dir() / "context_caches.lock"
+        try:
+            lock_file.parent.mkdir(parents=True, exist_ok=True)
+            f = open(lock_file, "a")
+        except OSError as e:
+            # The index is purely an optimization, so carry on without it being shared safely
+            logging.getLogger(__name__).warning(
+                f"Failed to lock context cache index {lock_file}: {str(e)}"
+            )
+            yield
+            return
+        with f:
+            # Other processes may hold the lock while they create a cache, so wait off the loop
+            await asyncio.to_thread(fcntl.flock, f.fileno(), fcntl.LOCK_EX)
+            yield
+
+
+async def get_context_cache(
+    *, system_prompt: str, model_name: str, api_key: str, ttl_seconds: int
+) -> str | None:
+    """Returns a Gemini context cache holding system_prompt, creating one if there isn't one.
+
+    Caches are recorded in an on-disk index so that separate processes (e.g. every target in a
+    build that shares the same deps) reuse the same one until it expires. The index is locked
+    while a cache is created, so concurrent processes wait for it rather than each create one.
+    Prompts the provider refuses to cache are recorded too, so that they're only tried once.
+
+    Args:
+        system_prompt: The system prompt to cache
+        model_name: The specific Gemini model the cache will be used with
+        api_key: API key for authentication
+        ttl_seconds: How long the provider should keep a newly created cache around
+
+    Returns:
+        The name of the context cache, or None if the prompt can't be cached
+    """
+    if len(system_prompt) < MIN_CONTEXT_CACHE_CHARS:
+        return None
+    key = _hash_parts(model_name, system_prompt)
+    if key in _uncacheable_prompts:
+        return None
+
+    # Concurrent requests for the same prompt should share one cache rather than each create one
+    async with _context_cache_index_lock():
+        index = _read_context_cache_index()
+        if key in index:
+            name = index[key].get("name")
+            if not name:
+                _uncacheable_prompts.add(key)
+            return name
+        try:
+            name, expire_time = await create_context_cache(
+                system_prompt=system_prompt,
+                model_name=model_name,
+                api_key=api_key,
+                ttl_seconds=ttl_seconds,
+            )
+        except Exception as e:
+            logging.getLogger(__name__).info(
+                f"Not using a context cache for the system prompt: {str(e)}"
+            )
+            _uncacheable_prompts.add(key)
+            # Only a refusal is worth sharing, other failures may not happen next time
+            if isinstance(e, ContextCacheRefused):
+                index[key] = {
+                    "name": None,
+                    "expire_time": time.time() + UNCACHEABLE_PROMPT_RECHECK_SECONDS,
+                }
+                _write_context_cache_index(index)
+            return None
+        index[key] = {"name": name, "expire_time": expire_time}
+        _write_context_cache_index(index)
+        return name
+
+
+async def forget_context_cache(*, system_prompt: str, model_name: str) -> None:
+    """Stops using the context cache holding system_prompt, e.g. after it was evicted early.
+
+    The next request for the same prompt creates a new one.
+    """
+    key = _hash_parts(model_name, system_prompt)
+    async with _context_cache_index_lock():
+        index = _read_context_cache_index()
+        if index.pop(key, None):
+            _write_context_cache_index(index)
+
+
+async def cached_call_llm(
+    *,
+    system_prompt: str,
+    english_description: str,
+    model_name: str,
+    api_key: str,
+    response_schema: type[BaseModel],
+    temperature: float = 0.2,
+    max_output_tokens: int = 8192,
+    use_cache: bool = True,
+    cache_nondeterministic: bool = False,
+    check_partial: Callable[[str], str | None] | None = None,
+    follow_up_messages: Sequence[ChatMessage] = (),
+    system_prompt_prefix: str = "",
+    context_cache_ttl: int = 0,
+) -> LlmResponse:
+    """Call the LLM via call_llm, serving identical requests from an on-disk cache.
+
+    Only deterministic (temperature == 0) requests are cached unless cache_nondeterministic is
+    set, since otherwise the cache would pin one arbitrary sample forever.
+
+    Args:
+        system_prompt: The system prompt to send to the LLM
+        english_description: The user message to send to the LLM
+        model_name: The specific Gemini model to use
+        api_key: API key for authentication
+        response_schema: The pydantic model the response must conform to
+        temperature: Sampling temperature (lower = more deterministic)
+        max_output_tokens: Maximum tokens in the response
+        use_cache: Whether to use the cache at all
+        cache_nondeterministic: Whether to also cache requests with a non-zero temperature
+        check_partial: If given, the response is streamed via call_llm_stream and checked with
+            this as it arrives
+        follow_up_messages: Conversation turns to send after english_description
+        system_prompt_prefix: Static start of the system prompt that's shared by many requests,
+            the full system prompt is system_prompt_prefix + system_prompt
+        context_cache_ttl: If non-zero, system_prompt_prefix is served from a Gemini context cache
+            that's kept for this many seconds
+
+    Returns:
+        An LlmResponse object containing the generated code and metadata
+    """
+    logger = logging.getLogger(__name__)
+    full_system_prompt = system_prompt_prefix + system_prompt
+
+    cache_file = None
+    if use_cache and (temperature == 0 or cache_nondeterministic):
+        key = compute_cache_key(
+            system_prompt=full_system_prompt,
+            english_description=english_description,
+            model_name=model_name,
+            response_schema=response_schema,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            follow_up_messages=follow_up_messages,
+        )
+        cache_file = get_cache_dir() / key[:2] / f"{key}.json"
+        cached_response = _read_cached_response(cache_file, response_schema)
+        if cached_response:
+            logger.info(f"Using cached LLM response {cache_file}")
+            return cached_response
+
+    async def send(system_prompt: str, cached_content: str | None) -> LlmResponse:
+        if check_partial:
+            return await call_llm_stream(
+                system_prompt=system_prompt,
+                english_description=english_description,
+                model_name=model_name,
+                api_key=api_key,
+                response_schema=response_schema,
+                check_partial=check_partial,
+                temperature=temperature,
+                max_output_tokens=max_output_tokens,
+                follow_up_messages=follow_up_messages,
+                cached_content=cached_content,
+            )
+        return await call_llm(
+            system_prompt=system_prompt,
+            english_description=english_description,
+            model_name=model_name,
+            api_key=api_key,
+            response_schema=response_schema,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            follow_up_messages=follow_up_messages,
+            cached_content=cached_content,
+        )
+
+    cached_content = None
+    if system_prompt_prefix and context_cache_ttl:
+        cached_content = await get_context_cache(
+            system_prompt=system_prompt_prefix,
+            model_name=model_name,
+            api_key=api_key,
+            ttl_seconds=context_cache_ttl,
+        )
+    if cached_content:
+        try:
+            response = await send(system_prompt, cached_content)
+        except RuntimeError as e:
+            if not is_context_cache_error(e):
+                raise
+            # The context cache may have been evicted early, retry once with the whole prompt
+            logger.warning(f"LLM call using a context cache failed: {str(e)}")
+            await forget_context_cache(
+                system_prompt=system_prompt_prefix, model_name=model_name
+            )
+            response = await send(full_system_prompt, None)
+    else:
+        response = await send(full_system_prompt, None)
+
+    if cache_file:
+        try:
+            _write_cached_response(cache_file, response)
+        except OSError as e:
+            # The cache is purely an optimization, never fail the request over it
+            logger.warning(f"Failed to write LLM cache entry {cache_file}: {str(e)}")
+
+    return response
@@ -0,0 +1,18 @@
+import logging
+import sys
+
+# The log format shared by the nattyc binaries.
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+def setup_logging(level: int = logging.INFO) -> None:
+    """Set up logging configuration.
+
+    Args:
+        level: The logging level to use
+    """
+    logging.basicConfig(
+        level=level,
+        format=LOG_FORMAT,
+        handlers=[logging.StreamHandler(sys.stderr)],
+    )
@@ -1,19 +1,33 @@
 # //tools/rules_vibe/llm_caller.py
+import ast
+import asyncio
+import functools
+import hashlib
 import json
 import logging
 import os
-import subprocess
+import re
+import shutil
 import sys
+import tempfile
+from collections import OrderedDict
 from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
-from typing import Dict, List, Literal, cast
+from typing import TYPE_CHECKING, Any, Literal, cast
 
 import asyncclick as click
 
-# Import the new Google Gen AI SDK
-from pydantic import BaseModel, Field
+from python.nattyc.javac_server import (
+    JavacServerError,
+    discard_javac_server,
+    get_javac_server,
+    javac_server_scope,
+)
+from python.nattyc.logging_setup import setup_logging
 
-from python.nattyc.llm import call_llm
+if TYPE_CHECKING:
+    from pydantic import BaseModel
 
 
 @dataclass
@@ -24,31 +38,69 @@ class ValidationResult:
     error_message: str | None = None
 
 
-class GeneratedCode(BaseModel):
-    reasoning: str = Field(description="Use this field to plan out your solution.")
-    generated_code: str = Field(
-        description="The generated source code implementation. MUST ONLY INCLUDE THE CODE ITSELF AND NOTHING ELSE."
-    )
+@functools.cache
+def _load_models() -> "type[BaseModel]":
+    """Defines the pydantic response models, deferring the pydantic import until first use.
+
+    Returns:
+        The GeneratedCode model class
+    """
+    from pydantic import BaseModel, Field
+
+    class GeneratedCode(BaseModel):
+        reasoning: str = Field(description="Use this field to plan out your solution.")
+        generated_code: str = Field(
+            description="The generated source code implementation. MUST ONLY INCLUDE THE CODE ITSELF AND NOTHING ELSE."
+        )
+
+    return GeneratedCode
+
 
+ERROR_FEEDBACK_TEMPLATE = """IMPORTANT: Your previous attempt at generating code failed validation with the following error:
 
-class Language(str):
-    """Enum-like class for supported programming languages."""
+{error_message}
+
+Please fix the issues and provide a COMPLETE implementation of the code, not just the changes.
+Make sure your code handles the errors mentioned above.
+"""
+
+
+class Language(str, Enum):
+    """Enum for supported programming languages."""
 
     PYTHON = "python"
     JAVA = "java"
 
 
-def setup_logging(level: int = logging.INFO) -> None:
-    """Set up logging configuration.
+# Fixed pieces of the system prompt, built once rather than on every call.
+_LANG_INTROS = {
+    Language.PYTHON: "You are a helpful assistant that translates English descriptions into Python code.",
+    Language.JAVA: "You are a helpful assistant that translates English descriptions into Java code.",
+}
 
-    Args:
-        level: The logging level to use
-    """
-    logging.basicConfig(
-        level=level,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        handlers=[logging.StreamHandler(sys.stderr)],
-    )
+_DEPENDENCIES_HEADERS = {
+    Language.PYTHON: """
+
+The following Python code snippets are dependencies that can be used in the generated implementation. 
+DO NOT DUPLICATE THE CODE IN THESE DEPENDENCIES. 
+Ensure the generated code correctly interacts with them via import statements if necessary:
+
+""",
+    Language.JAVA: """
+
+The following Java code snippets are dependencies that can be used in the generated implementation. 
+DO NOT DUPLICATE THE CODE IN THESE DEPENDENCIES. 
+Ensure the generated code correctly interacts with them via import statements if necessary:
+
+""",
+}
+
+_DOCUMENTATION_HEADER = """
+
+The following is collected documentation that should be referenced in planning the approach. This
+documentation includes necessary information for correct implementation:
+
+"""
 
 
 def construct_system_prompt(
@@ -62,6 +114,40 @@ def construct_system_prompt(
 ) -> str:
     """Constructs the system prompt for the LLM.
 
+    See construct_system_prompt_parts for the arguments.
+
+    Returns:
+        A formatted system prompt string for the LLM
+    """
+    return "".join(
+        construct_system_prompt_parts(
+            language,
+            dep_files_contents,
+            dep_doc_contents,
+            output_file,
+            package,
+            resource_files,
+            target_type,
+        )
+    )
+
+
+def construct_system_prompt_parts(
+    language: Language,
+    dep_files_contents: dict[str, str],
+    dep_doc_contents: dict[str, str],
+    output_file: Path,
+    package: str,
+    resource_files: list[Path] = [],
+    target_type: Literal["library", "binary"] = "library",
+) -> tuple[str, str]:
+    """Constructs the system prompt for the LLM, split into its static and target-specific parts.
+
+    The static part only depends on the language, deps and docs, so it's shared by every target
+    with the same deps and can be served from the provider's context cache. Deps and docs are
+    emitted sorted by name, so the same set of them always produces a byte-identical prefix no
+    matter what order they were passed in.
+
     Args:
         language: The target programming language
         dep_files_contents: Dictionary mapping dependency names to their code contents
@@ -72,64 +158,133 @@ def construct_system_prompt(
         target_type: Whether this is a "library" or "binary" target
 
     Returns:
-        A formatted system prompt string for the LLM
+        The static prefix and the target-specific suffix of the system prompt
     """
-    dependencies_section = ""
-    if dep_files_contents:
-        if language == Language.PYTHON:
-            dependencies_section += """
+    lang_intro = _LANG_INTROS.get(language)
+    if lang_intro is None:
+        raise ValueError(f"Unsupported language: {language}")
 
-The following Python code snippets are dependencies that can be used in the generated implementation. 
-DO NOT DUPLICATE THE CODE IN THESE DEPENDENCIES. 
-Ensure the generated code correctly interacts with them via import statements if necessary:
+    # Each section is memoized, so callers building many prompts over the same deps and docs
+    # only pay for formatting them once. The caches are bounded since long-lived processes (see
+    # daemon.py) see many different deps over their lifetime.
+    static_prefix = "".join(
+        (
+            lang_intro,
+            _dependencies_section(language, tuple(sorted(dep_files_contents.items()))),
+            _documentation_section(tuple(sorted(dep_doc_contents.items()))),
+        )
+    )
+    target_suffix = "".join(
+        (
+            _resource_files_section(tuple(resource_files)),
+            _requirements_section(
+                language, output_file.stem, package, tuple(resource_files), target_type
+            ),
+        )
+    )
+    return static_prefix, target_suffix
 
-"""
-        elif language == Language.JAVA:
-            dependencies_section += """
 
-The following Java code snippets are dependencies that can be used in the generated implementation. 
-DO NOT DUPLICATE THE CODE IN THESE DEPENDENCIES. 
-Ensure the generated code correctly interacts with them via import statements if necessary:
+@functools.lru_cache(maxsize=64)
+def _dependencies_section(
+    language: Language, dep_files_contents: tuple[tuple[str, str], ...]
+) -> str:
+    """Formats the dependency code section of the system prompt.
 
-"""
-        for name, content in dep_files_contents.items():
-            dependencies_section += f"# Dependency: {name}\n{content}\n---\n"
+    Args:
+        language: The target programming language
+        dep_files_contents: Pairs of dependency names and their code contents
 
-    documentation_section = ""
-    if dep_doc_contents:
-        documentation_section += """
+    Returns:
+        The dependencies section, or an empty string if there are no dependencies
+    """
+    if not dep_files_contents:
+        return ""
 
-The following is collected documentation that should be referenced in planning the approach. This
-documentation includes necessary information for correct implementation:
+    parts: list[str] = [_DEPENDENCIES_HEADERS[language]]
+    for name, content in dep_files_contents:
+        parts.extend(("# Dependency: ", name, "\n", content, "\n---\n"))
+    return "".join(parts)
 
-"""
-        for name, content in dep_doc_contents.items():
-            documentation_section += f"# Documentation: {name}\n{content}\n---\n"
 
-    resource_files_section = ""
-    if resource_files:
-        resource_files_section += """
+@functools.lru_cache(maxsize=64)
+def _documentation_section(dep_doc_contents: tuple[tuple[str, str], ...]) -> str:
+    """Formats the documentation section of the system prompt.
+
+    Args:
+        dep_doc_contents: Pairs of documentation names and their contents
+
+    Returns:
+        The documentation section, or an empty string if there are no docs
+    """
+    if not dep_doc_contents:
+        return ""
+
+    parts: list[str] = [_DOCUMENTATION_HEADER]
+    for name, content in dep_doc_contents:
+        parts.extend(("# Documentation: ", name, "\n", content, "\n---\n"))
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=64)
+def _resource_files_section(resource_files: tuple[Path, ...]) -> str:
+    """Formats the section of the system prompt listing the available resource files.
+
+    Args:
+        resource_files: Resource files that will be available to the generated program
+
+    Returns:
+        The resource files section, or an empty string if there are no resource files
+    """
+    if not resource_files:
+        return ""
+
+    parts: list[str] = [
+        """
 
 The following resource files will be available to the generated program:
 
 """
-        for resource_path in resource_files:
-            resource_name = resource_path.name
-            resource_files_section += f"# Resource file: {resource_name}\n"
+    ]
+    for resource_path in resource_files:
+        parts.extend(("# Resource file: ", resource_path.name, "\n"))
+    return "".join(parts)
 
-    # Choose language-specific requirements
-    if language == Language.PYTHON:
-        lang_intro = "You are a helpful assistant that translates English descriptions into Python code."
 
+@functools.lru_cache(maxsize=64)
+def _requirements_section(
+    language: Language,
+    class_name: str,
+    package: str,
+    resource_files: tuple[Path, ...],
+    target_type: Literal["library", "binary"],
+) -> str:
+    """Formats the language-specific requirements section of the system prompt.
+
+    Args:
+        language: The target programming language
+        class_name: The name the primary Java class must have, derived from the output file
+        package: The package that can be used for importing the generated file
+        resource_files: Resource files that will be available to the generated program
+        target_type: Whether this is a "library" or "binary" target
+
+    Returns:
+        The requirements section
+    """
+    # Choose language-specific requirements
+    if language is Language.PYTHON:
         resource_instruction = ""
         if resource_files:
-            resource_instruction = """
+            resource_instruction = "".join(
+                [
+                    """
 CRITICAL: When accessing resource files, you should read them using appropriate file handling methods.
 The following resource files are available:
 
-"""
-            for resource_path in resource_files:
-                resource_instruction += f"- {str(resource_path)}\n"
+""",
+                    *(f"- {str(resource_path)}\n" for resource_path in resource_files),
+                ]
+            )
 
         # Add specific instructions based on target type
         binary_instruction = ""
@@ -138,7 +293,7 @@ The following resource files are available:
 CRITICAL: You MUST create an executable Python program with a `if __name__ == "__main__":` block.
 """
 
-        requirements = f"""
+        return f"""
 Requirements for the generated code:
 1. Add proper type hints to all functions and variables
 2. Use Python 3.10+ syntax (e.g., use `list[str]` instead of `List[str]`)
@@ -149,11 +304,8 @@ Requirements for the generated code:
 
 Generate Python code for the natural language description the user will provide.
 """
-    elif language == Language.JAVA:
-        lang_intro = "You are a helpful assistant that translates English descriptions into Java code."
-
-        # Extract the base filename without extension for Java class naming
-        class_name = output_file.stem
+    elif language is Language.JAVA:
+        # The primary class must be named after the output file for Java
         class_instruction = f"""
 CRITICAL: You MUST name the primary public class '{class_name}' to match the output file name. 
 This is a strict Java requirement when the class is defined in a file named '{class_name}.java'.
@@ -167,12 +319,18 @@ This package declaration is required by the Java compiler and must exactly match
 
         resource_instruction = ""
         if resource_files:
-            resource_instruction = """
+            resource_instruction = "".join(
+                [
+                    """
 CRITICAL: When accessing resource files, you MUST use the following method to load each resource as an InputStream:
 
-"""
-            for resource_path in resource_files:
-                resource_instruction += f"For resource '{str(resource_path)}', use:\nInputStream is = {class_name}.class.getResourceAsStream(\"/{str(resource_path)}\");\n\n"
+""",
+                    *(
+                        f"For resource '{str(resource_path)}', use:\nInputStream is = {class_name}.class.getResourceAsStream(\"/{str(resource_path)}\");\n\n"
+                        for resource_path in resource_files
+                    ),
+                ]
+            )
 
         # Add specific instructions based on target type
         binary_instruction = ""
@@ -182,7 +340,7 @@ CRITICAL: This is a Java executable. Your code MUST include a `public static voi
 The main method should serve as the entry point for the program and provide complete functionality for a standalone application.
 """
 
-        requirements = f"""
+        return f"""
 Requirements for the generated code:
 1. Use Java 8 features when appropriate
 2. Include proper exception handling
@@ -196,22 +354,25 @@ Generate Java code for the natural language description the user will provide.
     else:
         raise ValueError(f"Unsupported language: {language}")
 
-    return f"{lang_intro}{dependencies_section}{documentation_section}{resource_files_section}{requirements}"
 
-
-def validate_generated_code(
+async def validate_generated_code(
     code: str,
     language: Language,
     output_file: Path | None = None,
     java_dep_jars: list[Path] = [],
+    javac_server: Path | None = None,
+    package: str | None = None,
 ) -> ValidationResult:
     """Basic validation of generated code.
 
     Args:
         code: The generated code to validate
         language: The programming language of the code
-        output_file: The path where the code has been written for Java compilation
+        output_file: The path the code will be written to, which Java class names must match
         java_dep_jars: List of jar files needed for Java compilation
+        javac_server: Optional path to the javac_server binary to compile with instead of
+            spawning a new javac process for every validation
+        package: The Java package the code is expected to declare, if known
 
     Returns:
         ValidationResult containing validity and any error message
@@ -222,16 +383,13 @@ def validate_generated_code(
             is_valid=False, error_message="Generated code is empty."
         )
 
-    if language == Language.PYTHON:
-        # Check if Python code compiles
-        try:
-            compile(code, "<string>", "exec")
-            return ValidationResult(is_valid=True)
-        except SyntaxError as e:
-            return ValidationResult(
-                is_valid=False, error_message=f"Python syntax error: {str(e)}"
-            )
-    elif language == Language.JAVA:
+    if language is Language.PYTHON:
+        # Check if Python code parses
+        syntax_error = python_syntax_error(code)
+        if syntax_error:
+            return ValidationResult(is_valid=False, error_message=syntax_error)
+        return ValidationResult(is_valid=True)
+    elif language is Language.JAVA:
         # First, basic validation to catch obvious issues
         if not ("class " in code or "interface " in code or "enum " in code):
             return ValidationResult(
@@ -241,46 +399,34 @@ def validate_generated_code(
 
         # For proper Java syntax validation, we'll compile the code with javac
         if output_file:
-            try:
-                # Construct the javac command
-                cmd = ["javac", output_file.as_posix()]
-
-                # Add classpath with dependencies if provided
-                if java_dep_jars:
-                    classpath = ":".join(jar.as_posix() for jar in java_dep_jars)
-                    cmd.extend(["-classpath", classpath])
-
-                # Run the javac command
-                result = subprocess.run(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    check=False,
-                    text=True,
-                )
-
-                # If compilation failed, capture the errors
-                if result.returncode != 0:
-                    error_message = "Java compilation failed:\n"
-                    if result.stdout:
-                        error_message += f"Compiler stdout: {result.stdout}\n"
-                    if result.stderr:
-                        error_message += f"Compiler stderr: {result.stderr}"
-
-                    logging.error(
-                        f"Java compilation failed with exit code {result.returncode}"
+            # Cheaply catch the most common mistakes first, these don't need a compiler at all
+            precheck_error = precheck_java_code(code, output_file.stem, package)
+            if precheck_error:
+                return ValidationResult(is_valid=False, error_message=precheck_error)
+
+            # Prefer the long-lived javac server, which avoids paying JVM startup on every retry
+            server = await get_javac_server(javac_server) if javac_server else None
+            if server:
+                try:
+                    result = await server.compile(
+                        {output_file.name: code}, java_dep_jars
                     )
-                    logging.error(f"Compilation command: {' '.join(cmd)}")
+                except JavacServerError as e:
+                    logging.warning(f"{str(e)}. Falling back to javac subprocesses.")
+                    await discard_javac_server()
+                else:
+                    if result.success:
+                        return ValidationResult(is_valid=True)
+                    error_message = f"Java compilation failed:\n{result.output}"
                     logging.error(error_message)
-
                     return ValidationResult(is_valid=False, error_message=error_message)
 
-                return ValidationResult(is_valid=True)
-            except Exception as e:
-                # If any exception occurs during compilation, log it and return with error
-                error_message = f"Error during Java compilation: {str(e)}"
-                logging.error(error_message)
-                return ValidationResult(is_valid=False, error_message=error_message)
+            # javac only compiles files on disk, so compile a scratch copy. The real output file
+            # is only written once the code is known to be valid.
+            with tempfile.TemporaryDirectory(prefix="nattyc-javac-") as tmp_dir:
+                source_file = Path(tmp_dir) / output_file.name
+                source_file.write_bytes(code.encode())
+                return await run_javac(source_file, java_dep_jars)
         else:
             # Fallback to basic validation if no output file is provided
             if "class " in code or "interface " in code or "enum " in code:
@@ -294,22 +440,455 @@ def validate_generated_code(
         raise ValueError(f"Unsupported language: {language}")
 
 
-def read_dependencies(dep_paths: List[Path]) -> Dict[str, str]:
-    """Read all dependency files.
+@functools.lru_cache(maxsize=64)
+def _java_declaration_patterns(
+    class_name: str, package: str | None
+) -> tuple[re.Pattern[str] | None, re.Pattern[str]]:
+    """Compiles the patterns for the package and primary class a Java file must declare.
+
+    Returns:
+        The package declaration pattern (None if the package isn't known) and the primary class
+        declaration pattern
+    """
+    # The package declaration may be preceded by comments, e.g. a license header
+    package_pattern = (
+        re.compile(
+            rf"^\s*(?:/\*(?:[^*]|\*(?!/))*\*/\s*)*package\s+{re.escape(package)}\s*;",
+            re.MULTILINE,
+        )
+        if package
+        else None
+    )
+    class_pattern = re.compile(
+        rf"\b(class|interface|enum|record)\s+{re.escape(class_name)}\b"
+    )
+    return package_pattern, class_pattern
+
+
+def precheck_java_code(code: str, class_name: str, package: str | None) -> str | None:
+    """Checks Java code for common mistakes that can be caught without invoking javac.
+
+    Args:
+        code: The Java code to check
+        class_name: The name the primary class must have to match its file name
+        package: The package the code must declare, if known
+
+    Returns:
+        An error message if a mistake was found, None otherwise
+    """
+    package_pattern, class_pattern = _java_declaration_patterns(class_name, package)
+    if package_pattern and not package_pattern.search(code):
+        return (
+            f"Java code must start with the package declaration 'package {package};'."
+        )
+    if not class_pattern.search(code):
+        return f"Java code must declare a class, interface, or enum named '{class_name}' to match its file name '{class_name}.java'."
+    if java_brace_depth(code) != 0:
+        return "Java code has unbalanced braces: every '{' must have a matching '}'."
+    return None
+
+
+# Results of recent syntax checks, keyed by a digest of the code so that the cache doesn't keep
+# every generated module alive. Ordered from least to most recently used.
+_SYNTAX_ERROR_CACHE_SIZE = 128
+_syntax_errors: OrderedDict[bytes, str | None] = OrderedDict()
+
+
+def python_syntax_error(code: str) -> str | None:
+    """Checks Python code for syntax errors.
+
+    This only parses the code to an AST rather than compiling it to bytecode, since syntactic
+    validity is all we need. Results are memoized so identical regenerations are free.
+
+    Args:
+        code: The Python code to check
+
+    Returns:
+        An error message describing the syntax error, or None if the code parses
+    """
+    key = hashlib.blake2b(code.encode(), digest_size=16).digest()
+    if key in _syntax_errors:
+        _syntax_errors.move_to_end(key)
+        return _syntax_errors[key]
+
+    try:
+        ast.parse(code, "<generated>")
+        error = None
+    except SyntaxError as e:
+        error = f"Python syntax error: {str(e)}"
+
+    _syntax_errors[key] = error
+    if len(_syntax_errors) > _SYNTAX_ERROR_CACHE_SIZE:
+        _syntax_errors.popitem(last=False)
+    return error
+
+
+# Exit code of the Nailgun client when it can't reach the Nailgun server.
+_NAILGUN_CONNECT_FAILED = 230
+
+_nailgun_unavailable = False
+
+
+def javac_command() -> list[str]:
+    """Returns the command to invoke javac with.
+
+    When the NAILGUN_PORT env var is set and the ng client is installed, javac is run inside the
+    already warm JVM of that Nailgun server rather than paying JVM startup for every compilation.
+    """
+    port = os.environ.get("NAILGUN_PORT")
+    if port and not _nailgun_unavailable and shutil.which("ng"):
+        return ["ng", "--nailgun-port", port, "com.sun.tools.javac.Main"]
+    return ["javac"]
+
+
+@functools.lru_cache(maxsize=32)
+def _classpath(java_dep_jars: tuple[Path, ...]) -> str:
+    """Joins jar files into a classpath, once per distinct set of jars."""
+    return ":".join(jar.as_posix() for jar in java_dep_jars)
+
+
+async def run_javac(source_file: Path, java_dep_jars: list[Path]) -> ValidationResult:
+    """Validates a Java source file by compiling it in a new javac process.
+
+    Args:
+        source_file: The path where the code has been written
+        java_dep_jars: List of jar files needed for Java compilation
+
+    Returns:
+        ValidationResult containing validity and any error message
+    """
+    global _nailgun_unavailable
+    try:
+        # Construct the javac command
+        cmd = [*javac_command(), source_file.as_posix()]
+
+        # Add classpath with dependencies if provided
+        if java_dep_jars:
+            cmd.extend(["-classpath", _classpath(tuple(java_dep_jars))])
+
+        # Run the javac command without blocking the event loop, so that other candidates and
+        # jobs keep going meanwhile. It reports diagnostics on stderr, so that's all we capture,
+        # and it's only decoded if compilation fails.
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # Nobody is waiting on this validation anymore, so don't leave javac running
+            process.kill()
+            await process.wait()
+            raise
+        if cmd[0] == "ng" and process.returncode == _NAILGUN_CONNECT_FAILED:
+            logging.warning(
+                "Couldn't connect to the Nailgun server. Falling back to javac subprocesses."
+            )
+            _nailgun_unavailable = True
+            return await run_javac(source_file, java_dep_jars)
+
+        # If compilation failed, capture the errors
+        if process.returncode != 0:
+            error_message = "Java compilation failed:\n"
+            if stderr:
+                error_message += f"Compiler stderr: {stderr.decode(errors='replace')}"
+
+            logging.error(
+                f"Java compilation failed with exit code {process.returncode}"
+            )
+            logging.error(f"Compilation command: {' '.join(cmd)}")
+            logging.error(error_message)
+
+            return ValidationResult(is_valid=False, error_message=error_message)
+
+        return ValidationResult(is_valid=True)
+    except Exception as e:
+        # If any exception occurs during compilation, log it and return with error
+        error_message = f"Error during Java compilation: {str(e)}"
+        logging.error(error_message)
+        return ValidationResult(is_valid=False, error_message=error_message)
+
+
+_GENERATED_CODE_KEY_RE = re.compile(r'"generated_code"\s*:\s*"')
+
+# SyntaxErrors this many lines from the end of a partial Python response may just be truncation.
+_PARTIAL_PYTHON_SLACK_LINES = 3
+
+# SyntaxErrors that are expected when parsing a prefix of otherwise valid Python.
+_PARTIAL_PYTHON_TRUNCATION_ERRORS = (
+    "was never closed",
+    "unterminated",
+    "unexpected EOF",
+    "expected an indented block",
+)
+
+
+def extract_partial_generated_code(raw_response: str) -> tuple[str, bool] | None:
+    """Extracts the generated_code field from a (possibly incomplete) raw GeneratedCode JSON.
+
+    Args:
+        raw_response: The raw JSON response text received from the LLM so far
+
+    Returns:
+        The generated code received so far and whether it is complete, or None if the
+        generated_code field hasn't started yet
+    """
+    match = _GENERATED_CODE_KEY_RE.search(raw_response)
+    if not match:
+        return None
+    start = match.end()
+
+    # Find the closing quote of the JSON string, if it has arrived yet
+    escaped = False
+    for i in range(start, len(raw_response)):
+        c = raw_response[i]
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c == '"':
+            return json.loads(raw_response[start - 1 : i + 1]), True
+
+    # The string is still being generated. Drop any partially received escape sequence
+    # (at most 6 chars, e.g. a truncated \uXXXX) so the rest can be decoded.
+    body = raw_response[start:]
+    for trim in range(min(len(body), 6) + 1):
+        try:
+            return json.loads(f'"{body[: len(body) - trim]}"'), False
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def check_partial_generated_code(raw_response: str, language: Language) -> str | None:
+    """Cheaply checks a partially streamed GeneratedCode response for fatal errors.
+
+    Only errors that can't be explained by the code simply being incomplete are reported, so
+    that the stream can be abandoned early without ever rejecting a response that would have
+    turned out to be valid. The complete response is still fully validated afterwards.
+
+    Args:
+        raw_response: The raw JSON response text received from the LLM so far
+        language: The programming language of the generated code
+
+    Returns:
+        An error message if the response is already known to be invalid, None otherwise
+    """
+    extracted = extract_partial_generated_code(raw_response)
+    if not extracted:
+        return None
+    code, complete = extracted
+    if complete:
+        # Leave it to the full validation once the response is done
+        return None
+
+    if language is Language.PYTHON:
+        try:
+            ast.parse(code)
+        except SyntaxError as e:
+            if any(msg in str(e.msg) for msg in _PARTIAL_PYTHON_TRUNCATION_ERRORS):
+                return None
+            if (
+                e.lineno is None
+                or e.lineno > code.count("\n") - _PARTIAL_PYTHON_SLACK_LINES
+            ):
+                return None
+            return f"Python syntax error: {str(e)}"
+    elif language is Language.JAVA:
+        if has_unbalanced_closing_brace(code):
+            return "Java code has unbalanced braces: found a '}' with no matching '{'."
+    return None
+
+
+def has_unbalanced_closing_brace(code: str) -> bool:
+    """Checks if Java code ever closes more braces than it has opened.
+
+    Unlike checking that the braces balance overall, this is safe to run on a prefix of the code.
+
+    Args:
+        code: The (possibly incomplete) Java code to check
+
+    Returns:
+        True if a closing brace without a matching opening brace was found
+    """
+    return java_brace_depth(code) < 0
+
+
+def java_brace_depth(code: str) -> int:
+    """Computes how many braces are left open at the end of Java code.
+
+    Braces in comments, string literals and char literals are ignored.
+
+    Args:
+        code: The (possibly incomplete) Java code to check
+
+    Returns:
+        The number of unclosed braces, or -1 as soon as a '}' is found with no matching '{'
+    """
+    depth = 0
+    i = 0
+    n = len(code)
+    while i < n:
+        c = code[i]
+        if c == "/" and code.startswith("//", i):
+            newline = code.find("\n", i)
+            i = n if newline == -1 else newline
+        elif c == "/" and code.startswith("/*", i):
+            end = code.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+            continue
+        elif c == '"' or c == "'":
+            # Skip to the matching unescaped quote on the same line
+            i += 1
+            while i < n and code[i] != c and code[i] != "\n":
+                i += 2 if code[i] == "\\" else 1
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth < 0:
+                return -1
+        i += 1
+    return depth
+
+
+def compute_input_fingerprint(
+    *,
+    input_files: list[tuple[Path, bytes]],
+    java_dep_jars: list[Path],
+    resource_files: list[Path],
+    settings: list[str],
+) -> str:
+    """Computes a fingerprint of everything that feeds into generating a file.
 
     Args:
-        dep_paths: List of paths to dependency files
+        input_files: Paths and contents of the input text description, dependency code and
+            documentation files
+        java_dep_jars: Paths to Java dependency jars used for validation
+        resource_files: Paths to resource files available to the generated program
+        settings: Any other settings that affect the generated output
 
     Returns:
-        Dictionary mapping dependency names to their code contents
+        Hex-encoded fingerprint
     """
-    dep_contents: Dict[str, str] = {}
+    h = hashlib.blake2b(digest_size=16)
+
+    def update(data: bytes) -> None:
+        # Length-prefix each part so that different splits of the same bytes can't collide
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+
+    for setting in settings:
+        update(setting.encode())
+    # Resource files are only referenced by path in the prompt, and jars only affect validation
+    for path in [*java_dep_jars, *resource_files]:
+        update(path.as_posix().encode())
+    for path, data in input_files:
+        update(path.as_posix().encode())
+        update(data)
+    return h.hexdigest()
 
-    for dep_path in dep_paths:
-        dep_name = dep_path.as_posix()
-        dep_contents[dep_name] = dep_path.read_text()
 
-    return dep_contents
+def get_fingerprint_file(output_file: Path) -> Path:
+    """Returns the path of the sidecar file storing the input fingerprint for output_file."""
+    return output_file.with_name(output_file.name + ".fp")
+
+
+def read_fingerprint(fingerprint_file: Path) -> str | None:
+    """Reads a previously stored input fingerprint, or None if there isn't one."""
+    try:
+        return fingerprint_file.read_text(errors="ignore")
+    except OSError:
+        return None
+
+
+def write_fingerprint(fingerprint_file: Path, fingerprint: str) -> None:
+    """Atomically stores an input fingerprint."""
+    tmp_file = fingerprint_file.with_name(fingerprint_file.name + ".tmp")
+    try:
+        tmp_file.write_text(fingerprint)
+        os.replace(tmp_file, fingerprint_file)
+    except OSError as e:
+        # The fingerprint is purely an optimization, never fail the build over it
+        logging.warning(
+            f"Failed to write input fingerprint {fingerprint_file}: {str(e)}"
+        )
+
+
+def write_output_file(
+    output_file: Path, generated_code: str, language: Language, package: str
+) -> None:
+    """Atomically writes the generated code with any language-specific header.
+
+    The code is written to a temp file that is then renamed over output_file, so readers (javac,
+    file watchers, etc.) never observe a partially written file.
+
+    Args:
+        output_file: The path to write the generated code to
+        generated_code: The generated code
+        language: The programming language of the code
+        package: The package that can be used for importing the generated file
+    """
+    if language is Language.PYTHON:
+        contents = (
+            "# Usage: Import from this package using the following:\n"
+            f"# from {package} import <name to import>\n\n{generated_code}"
+        )
+    else:
+        # For Java, the package declaration should already be in the code
+        contents = generated_code
+
+    tmp_file = output_file.with_name(output_file.name + ".tmp")
+    # Write the whole file in one go rather than through a buffered text stream
+    tmp_file.write_bytes(contents.encode())
+    os.replace(tmp_file, output_file)
+
+
+_TRAILING_WHITESPACE_RE = re.compile(r"[ \t]+$", re.MULTILINE)
+_BLANK_LINE_RUN_RE = re.compile(r"\n{3,}")
+
+
+def compact_dependency(content: str) -> str:
+    """Strips trailing whitespace and collapses runs of blank lines to save prompt tokens."""
+    return _BLANK_LINE_RUN_RE.sub("\n\n", _TRAILING_WHITESPACE_RE.sub("", content))
+
+
+async def read_files(paths: list[Path]) -> list[tuple[Path, bytes]]:
+    """Read files concurrently, since reading many small files is dominated by syscall latency.
+
+    Args:
+        paths: List of paths to read
+
+    Returns:
+        Pairs of each path and its contents, in the same order as paths
+    """
+    contents = await asyncio.gather(
+        *(asyncio.to_thread(path.read_bytes) for path in paths)
+    )
+    return list(zip(paths, contents))
+
+
+def collect_dependencies(deps: list[tuple[Path, bytes]]) -> dict[str, str]:
+    """Prepares dependency files for the prompt, deduplicating identical contents.
+
+    Codebases often pass the same file via multiple paths (e.g. transitive deps), so files with
+    identical contents are only included once, under the comma-joined list of all their names.
+
+    Args:
+        deps: Pairs of dependency file paths and their contents
+
+    Returns:
+        Dictionary mapping (comma-joined, sorted) dependency names to their code contents
+    """
+    by_hash: dict[bytes, tuple[list[str], bytes]] = {}
+    for dep_path, data in deps:
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        by_hash.setdefault(digest, ([], data))[0].append(dep_path.as_posix())
+    return {
+        ", ".join(sorted(names)): compact_dependency(data.decode())
+        for names, data in by_hash.values()
+    }
 
 
 @click.command(help="Generate code from English descriptions using LLMs")
@@ -323,8 +902,7 @@ def read_dependencies(dep_paths: List[Path]) -> Dict[str, str]:
         resolve_path=True,
         readable=True,
     ),
-    required=True,
-    help="Path to input text description file",
+    help="Path to input text description file. Required unless using --batch_manifest.",
 )
 @click.option(
     "--output_file",
@@ -335,13 +913,13 @@ def read_dependencies(dep_paths: List[Path]) -> Dict[str, str]:
         resolve_path=True,
         writable=True,
     ),
-    required=True,
-    help="Path to output code file",
+    help="Path to output code file. Required unless using --batch_manifest.",
 )
 @click.option(
     "--language",
-    type=click.Choice([Language.PYTHON, Language.JAVA]),
-    default=Language.PYTHON,
+    type=click.Choice([language.value for language in Language]),
+    default=Language.PYTHON.value,
+    callback=lambda ctx, param, value: Language(value),
     help="Target programming language",
 )
 @click.option(
@@ -352,8 +930,7 @@ def read_dependencies(dep_paths: List[Path]) -> Dict[str, str]:
 )
 @click.option(
     "--package",
-    required=True,
-    help="The package that can be used to specify importing this generated file.",
+    help="The package that can be used to specify importing this generated file. Required unless using --batch_manifest.",
 )
 @click.option(
     "--dep_file",
@@ -397,6 +974,18 @@ def read_dependencies(dep_paths: List[Path]) -> Dict[str, str]:
     default=[],
     help="Paths to Java dependency jar files needed for compilation.",
 )
+@click.option(
+    "--javac_server",
+    type=click.Path(
+        exists=True,
+        file_okay=True,
+        dir_okay=False,
+        path_type=Path,
+        resolve_path=True,
+    ),
+    default=None,
+    help="Path to the javac_server binary used to validate Java code without a JVM startup per attempt.",
+)
 @click.option(
     "--resource_file",
     multiple=True,
@@ -419,12 +1008,155 @@ def read_dependencies(dep_paths: List[Path]) -> Dict[str, str]:
 @click.option(
     "--max_output_tokens", type=int, default=8192, help="Maximum output tokens"
 )
+@click.option(
+    "--speculative_k",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of candidates to sample in parallel per attempt. The first one to pass validation is used.",
+)
+@click.option(
+    "--stream/--no_stream",
+    default=True,
+    help="Stream LLM responses so that obviously invalid code can be rejected before generation finishes.",
+)
+@click.option(
+    "--no_cache",
+    is_flag=True,
+    default=False,
+    help="Always call the LLM instead of reusing cached responses from $NATTYC_CACHE_DIR (default ~/.cache/nattyc).",
+)
+@click.option(
+    "--cache_nondeterministic",
+    is_flag=True,
+    default=False,
+    help="Also cache LLM responses when the temperature is non-zero.",
+)
+@click.option(
+    "--context_cache_ttl",
+    type=click.IntRange(min=0),
+    default=3600,
+    help="Seconds to keep the static part of the system prompt (deps and docs) in Gemini's context cache so targets sharing it skip re-processing it. 0 disables context caching.",
+)
 @click.option(
     "--api_key_env_var",
     default="LLM_API_KEY",
     help="Environment variable name for API key",
 )
+@click.option(
+    "--verbose",
+    is_flag=True,
+    default=False,
+    help="Log LLM request metrics (e.g. rate limiting) to help tune LLM_MAX_CONCURRENCY.",
+)
+@click.option(
+    "--batch_manifest",
+    type=click.Path(
+        exists=True,
+        file_okay=True,
+        dir_okay=False,
+        path_type=Path,
+        resolve_path=True,
+        readable=True,
+    ),
+    default=None,
+    help="JSON list of jobs to generate concurrently in this one process. Each job is an object mapping option names (e.g. input_txt) to values, and falls back to the options given on the command line for any it doesn't set.",
+)
+@click.pass_context
 async def main(
+    ctx: click.Context,
+    verbose: bool,
+    batch_manifest: Path | None,
+    **options: Any,
+) -> None:
+    """Main function to orchestrate the code generation process."""
+    # Set up logging
+    setup_logging()
+    logger = logging.getLogger(__name__)
+
+    if batch_manifest:
+        jobs = read_batch_manifest(ctx, batch_manifest, options)
+        from python.nattyc.llm import client_scope
+
+        # Every job shares one Gemini client and javac server. Each job writes its output as soon
+        # as it's done rather than waiting on the rest of the batch.
+        async with client_scope(), javac_server_scope():
+            results = await asyncio.gather(*(generate_file(**job) for job in jobs))
+        success = all(results)
+        if not success:
+            logger.error(f"{results.count(False)} of {len(jobs)} jobs failed")
+    else:
+        _check_required_job_options(ctx, options)
+        success = await generate_file(**options)
+
+    if verbose:
+        from python.nattyc.llm import log_metrics
+
+        log_metrics()
+
+    if not success:
+        sys.exit(1)
+
+
+# Options that must be given, either on the command line or by every job in a batch manifest.
+_REQUIRED_JOB_OPTIONS = ("input_txt", "output_file", "package")
+
+
+def _check_required_job_options(ctx: click.Context, job: dict[str, Any]) -> None:
+    """Raises a click.MissingParameter for the first required option missing from job."""
+    for name in _REQUIRED_JOB_OPTIONS:
+        if job[name] is None:
+            param = next(p for p in ctx.command.params if p.name == name)
+            raise click.MissingParameter(ctx=ctx, param=param)
+
+
+def read_batch_manifest(
+    ctx: click.Context, batch_manifest: Path, defaults: dict[str, Any]
+) -> list[dict[str, Any]]:
+    """Reads the jobs in a batch manifest.
+
+    Args:
+        ctx: The click context, whose options are used to convert and check the jobs' values
+        batch_manifest: Path to a JSON list of jobs, each an object mapping option names to values
+            (lists for repeatable options like dep_file)
+        defaults: Option values for jobs that don't set them, from the command line
+
+    Returns:
+        The keyword arguments for generate_file for each job
+
+    Raises:
+        click.BadParameter: If the manifest is malformed or a job has an invalid option value
+        click.MissingParameter: If a job is missing a required option
+    """
+    try:
+        raw_jobs = json.loads(batch_manifest.read_text())
+    except ValueError as e:
+        raise click.BadParameter(str(e), ctx=ctx, param_hint="--batch_manifest")
+    if not isinstance(raw_jobs, list) or not all(
+        isinstance(raw_job, dict) for raw_job in raw_jobs
+    ):
+        raise click.BadParameter(
+            "must be a JSON list of objects", ctx=ctx, param_hint="--batch_manifest"
+        )
+
+    params = {p.name: p for p in ctx.command.params if p.name in defaults}
+    jobs = []
+    for i, raw_job in enumerate(raw_jobs):
+        unknown = raw_job.keys() - params.keys()
+        if unknown:
+            raise click.BadParameter(
+                f"job {i} has unknown options: {', '.join(sorted(unknown))}",
+                ctx=ctx,
+                param_hint="--batch_manifest",
+            )
+        job = dict(defaults)
+        for name, value in raw_job.items():
+            job[name] = params[name].process_value(ctx, value)
+        _check_required_job_options(ctx, job)
+        jobs.append(job)
+    return jobs
+
+
+async def generate_file(
     input_txt: Path,
     output_file: Path,
     language: Language,
@@ -433,29 +1165,77 @@ async def main(
     dep_file: list[Path],
     dep_doc: list[Path],
     java_dep_jar: list[Path],
+    javac_server: Path | None,
     resource_file: list[Path],
     llm_model: str,
     temperature: float,
     max_output_tokens: int,
+    speculative_k: int,
+    stream: bool,
+    no_cache: bool,
+    cache_nondeterministic: bool,
+    context_cache_ttl: int,
     api_key_env_var: str,
-) -> None:
-    """Main function to orchestrate the code generation process."""
-    # Set up logging
-    setup_logging()
+) -> bool:
+    """Generates a single file, retrying until the generated code passes validation.
+
+    Args are as described by the corresponding command line options.
+
+    Returns:
+        Whether the file was successfully generated
+    """
     logger = logging.getLogger(__name__)
 
     try:
-        # Read input English text
-        english_text = input_txt.read_text()
+        # Concurrently read the input English text, dependency code files, and docs up front. Their
+        # contents feed both the fingerprint and the prompt, so each file is only read once.
+        input_files = await read_files([input_txt, *dep_file, *dep_doc])
+        dep_files_end = 1 + len(dep_file)
+
+        # Skip regeneration entirely if nothing that feeds into it has changed since the last run
+        fingerprint = compute_input_fingerprint(
+            input_files=input_files,
+            java_dep_jars=java_dep_jar,
+            resource_files=resource_file,
+            settings=[
+                language.value,
+                target_type,
+                package,
+                llm_model,
+                repr(temperature),
+                repr(max_output_tokens),
+            ],
+        )
+        fingerprint_file = get_fingerprint_file(output_file)
+        if output_file.exists() and read_fingerprint(fingerprint_file) == fingerprint:
+            logger.info(f"Inputs unchanged, reusing previously generated {output_file}")
+            return True
+
+        # Get API Key. Checked before doing any other work so a missing key fails fast.
+        api_key = os.environ.get(api_key_env_var)
+        if not api_key:
+            logger.error(f"Error: {api_key_env_var} environment variable not set.")
+            return False
+
+        # pydantic and the Gemini SDK (via llm) are slow to import, so they're only loaded once we
+        # know we're actually going to call the LLM. Runs that exit early (--help, unchanged
+        # inputs) skip them.
+        from python.nattyc.llm import (
+            ChatMessage,
+            LlmStreamAborted,
+            client_scope,
+        )
+        from python.nattyc.llm_cache import cached_call_llm
 
-        # Read dependency code files
-        dep_files_contents = read_dependencies(dep_file)
+        GeneratedCode = _load_models()
 
-        # Read docs to seed the LLM with context
-        dep_docs_contents = read_dependencies(dep_doc)
+        # Seed the LLM with the dependency code files and docs as context
+        english_text = input_files[0][1].decode()
+        dep_files_contents = collect_dependencies(input_files[1:dep_files_end])
+        dep_docs_contents = collect_dependencies(input_files[dep_files_end:])
 
-        # Construct the prompt
-        system_prompt = construct_system_prompt(
+        # Construct the prompt. The static prefix goes first so providers can reuse it across targets.
+        system_prompt_prefix, system_prompt = construct_system_prompt_parts(
             language=language,
             dep_files_contents=dep_files_contents,
             dep_doc_contents=dep_docs_contents,
@@ -465,98 +1245,182 @@ async def main(
             target_type=target_type,
         )
 
-        # Get API Key
-        api_key = os.environ.get(api_key_env_var)
-        if not api_key:
-            logger.error(f"Error: {api_key_env_var} environment variable not set.")
-            sys.exit(1)
-
         # Initialize variables for retry loop
         max_retries = 5
         retries = 0
         success = False
         validation_result = None
         response = None
+        generated_code = ""
 
-        while retries <= max_retries:
-            # Call the LLM
-            response = await call_llm(
-                system_prompt=system_prompt,
-                english_description=english_text,
-                model_name=llm_model,
-                api_key=api_key,
-                response_schema=GeneratedCode,
-                temperature=temperature,
-                max_output_tokens=max_output_tokens,
-            )
-            generated_code = cast(GeneratedCode, response.parsed).generated_code
-
-            # Write the output with appropriate language-specific header
-            # This ensures the file exists for Java compilation validation
-            with open(output_file, "w") as f:
-                if language == Language.PYTHON:
-                    f.write("# Usage: Import from this package using the following:\n")
-                    f.write(f"# from {package} import <name to import>\n\n")
-                # For Java, the package declaration should already be in the code
-                f.write(generated_code)
-
-            # Validate the generated code
-            if language == Language.JAVA:
-                # For Java, pass the output file and jar dependencies for proper compilation
-                validation_result = validate_generated_code(
-                    generated_code, language, output_file, java_dep_jar
-                )
-            else:
-                # For Python, we can validate without the file
-                validation_result = validate_generated_code(generated_code, language)
-
-            # If validation passed, mark as success and break out of the retry loop
-            if validation_result.is_valid:
-                success = True
-                break
-
-            # Increment retry counter and log retry attempt
-            retries += 1
-            logger.info(f"Validation failed. Retry {retries}/{max_retries}...")
-
-            # If we still have retries left, update the system prompt with error feedback
-            if retries < max_retries:
-                error_feedback = f"""
-
-IMPORTANT: Your previous attempt at generating code failed validation with the following error:
-
-{validation_result.error_message}
-
-Here is your previous code that needs to be fixed:
-
-```
-{generated_code}
-```
+        # When streaming, abandon responses as soon as they're known to be invalid
+        check_partial = (
+            (lambda raw: check_partial_generated_code(raw, language))
+            if stream
+            else None
+        )
 
-Please fix the issues and provide a COMPLETE implementation of the code, not just the changes.
-Make sure your code handles the errors mentioned above.
-"""
-                # Update system prompt with error feedback for retry
-                system_prompt = system_prompt + error_feedback
+        # The system prompt and first user turn are kept byte-for-byte identical across retries so
+        # that the provider's prefix cache can be hit on every attempt. Retry feedback is sent as
+        # follow-up turns holding only the most recent failure, so retries don't grow the prompt.
+        follow_up_messages: list[ChatMessage] = []
+
+        # Share one Gemini client (and its connections) and javac server across every attempt
+        async with client_scope(), javac_server_scope():
+            while retries <= max_retries:
+                # Speculatively sample several candidates at once and accept the first that validates.
+                # Candidates are validated one at a time as they arrive.
+                tasks = [
+                    asyncio.create_task(
+                        cached_call_llm(
+                            system_prompt_prefix=system_prompt_prefix,
+                            system_prompt=system_prompt,
+                            english_description=english_text,
+                            model_name=llm_model,
+                            api_key=api_key,
+                            response_schema=GeneratedCode,
+                            temperature=temperature,
+                            max_output_tokens=max_output_tokens,
+                            use_cache=not no_cache,
+                            cache_nondeterministic=cache_nondeterministic,
+                            context_cache_ttl=context_cache_ttl,
+                            check_partial=check_partial,
+                            follow_up_messages=follow_up_messages,
+                        )
+                    )
+                    for _ in range(speculative_k)
+                ]
+                try:
+                    candidates_validated = 0
+                    llm_error: Exception | None = None
+                    for next_response in asyncio.as_completed(tasks):
+                        try:
+                            response = await next_response
+                        except LlmStreamAborted as e:
+                            # The response was already known to be invalid part way through
+                            logger.info(
+                                f"Abandoned invalid LLM response early: {e.error_message}"
+                            )
+                            extracted = extract_partial_generated_code(e.partial_text)
+                            generated_code = extracted[0] if extracted else ""
+                            validation_result = ValidationResult(
+                                is_valid=False, error_message=e.error_message
+                            )
+                            candidates_validated += 1
+                            continue
+                        except Exception as e:
+                            # Other speculative samples may still succeed, only give up if all fail.
+                            logger.warning(f"LLM call failed: {str(e)}")
+                            llm_error = e
+                            continue
+                        generated_code = cast(
+                            GeneratedCode, response.parsed
+                        ).generated_code
+
+                        # Validate the generated code
+                        if language is Language.JAVA:
+                            # For Java, pass the output file and jar dependencies for proper compilation
+                            validation_result = await validate_generated_code(
+                                generated_code,
+                                language,
+                                output_file,
+                                java_dep_jar,
+                                javac_server,
+                                package,
+                            )
+                        else:
+                            # For Python, we can validate without the file
+                            validation_result = await validate_generated_code(
+                                generated_code, language
+                            )
+                        candidates_validated += 1
+
+                        # If validation passed, write the output with the appropriate
+                        # language-specific header and stop waiting on other candidates. Invalid
+                        # code never touches output_file.
+                        if validation_result.is_valid:
+                            write_output_file(
+                                output_file, generated_code, language, package
+                            )
+                            success = True
+                            break
+
+                    if candidates_validated == 0 and llm_error:
+                        raise llm_error
+                finally:
+                    # Don't keep paying for samples we no longer need
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+
+                if success:
+                    break
+
+                # Increment retry counter and log retry attempt
+                retries += 1
+                logger.info(f"Validation failed. Retry {retries}/{max_retries}...")
+
+                # If we still have retries left, replace the feedback with the latest failure
+                if retries < max_retries and validation_result:
+                    follow_up_messages = [
+                        ChatMessage(
+                            "user",
+                            ERROR_FEEDBACK_TEMPLATE.format(
+                                error_message=validation_result.error_message
+                            ),
+                        )
+                    ]
+                    # An early-abandoned stream may not have produced any code to show
+                    if generated_code:
+                        follow_up_messages.insert(
+                            0, ChatMessage("model", generated_code)
+                        )
 
         # After the loop, check if we succeeded or exhausted all retries
         if success:
+            write_fingerprint(fingerprint_file, fingerprint)
+
             # Log success message with usage stats
             logger.info(f"Successfully generated {output_file}")
             if response:
                 logger.info(f"Usage stats: {json.dumps(response.usage)}")
-        else:
-            # Log the final error and exit with failure
-            if validation_result:
-                logger.error(
-                    f"Generated code failed validation after {max_retries} attempts. Last error: {validation_result.error_message}"
-                )
-            sys.exit(1)
+            return True
+
+        # Log the final error and report failure
+        if validation_result:
+            logger.error(
+                f"Generated code failed validation after {max_retries} attempts. Last error: {validation_result.error_message}"
+            )
+        return False
 
     except Exception as e:
-        logger.error(f"Error: {str(e)}")
-        sys.exit(1)
+        logger.error(f"Error generating {output_file}: {str(e)}")
+        return False
+
+
+async def run(argv: list[str]) -> int:
+    """Runs the CLI in-process, returning its exit code rather than exiting.
+
+    This lets long-lived processes (see daemon.py) handle many invocations.
+
+    Args:
+        argv: The command line arguments, excluding the program name
+
+    Returns:
+        The exit code of the invocation
+    """
+    try:
+        return await main.main(argv, prog_name="nattyc", standalone_mode=False) or 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 1
+    except click.ClickException as e:
+        logging.getLogger(__name__).error(f"Error: {e.format_message()}")
+        return e.exit_code
+    except click.Abort:
+        return 1
 
 
 if __name__ == "__main__":
-    main()
+    from python.nattyc.daemon import run_cli
+
+    run_cli(main, run)
@@ -54,6 +54,9 @@ def _natty_library_impl(ctx):
     args.add("--llm_model", ctx.attr.llm_model)
     args.add("--temperature", ctx.attr.temperature)
     args.add("--max_output_tokens", ctx.attr.max_output_tokens)
+    # Persistent workers require the arguments to be passed via a param file.
+    args.use_param_file("@%s", use_always = True)
+    args.set_param_file_format("multiline")
     
     # If the language is Java, pass Java dependency jars for compilation
     if language == "java":
@@ -64,6 +67,8 @@ def _natty_library_impl(ctx):
                 for jar in dep[JavaInfo].transitive_compile_time_jars.to_list():
                     args.add("--java_dep_jar", jar.path)
                     java_dep_jars.append(jar)
+        # Validate with a long-lived javac server rather than spawning a new JVM per attempt.
+        args.add("--javac_server", ctx.executable._javac_server.path)
 
     # Define the inputs for the action
     inputs = [input_txt] + dep_files + ctx.files.docs + ctx.files.resources + [ctx.executable._nattyc]
@@ -78,11 +83,19 @@ def _natty_library_impl(ctx):
         executable = ctx.executable._nattyc,
         arguments = [args],
         inputs = depset(inputs), # Use depset for efficiency
+        tools = [ctx.attr._javac_server[DefaultInfo].files_to_run] if language == "java" else [],
         outputs = [output_file],
         progress_message = "Generating %s code for %s using Natty" % (language.capitalize(), ctx.label),
         mnemonic = "Natty",
         # WARNING: requires-network can disable sandboxing & affect caching/remote execution.
-        execution_requirements = {"requires-network": "True"},
+        # nattyc can run as a persistent worker, so that many actions share one process (and its
+        # open connections) rather than each paying Python startup. See python/nattyc/daemon.py.
+        execution_requirements = {
+            "requires-network": "True",
+            "supports-workers": "1",
+            "supports-multiplex-workers": "1",
+            "requires-worker-protocol": "json",
+        },
         # Enable LLM_API_KEY env var to be passed along to nattyc via --action_env=LLM_API_KEY=foo
         # Also allows the javac command installed on the machine to be used rather than Bazel's
         # builtin javac toolchain. TODO! Make this use the hermetic javac toolchain.
@@ -153,6 +166,13 @@ _natty_library_rule = rule(
             allow_files = True,
             doc = "Internal: The tool used to call the LLM for code generation.",
         ),
+        "_javac_server": attr.label(
+            default = Label("//java/com/natty/javac:javac_server"),
+            cfg = "exec", # Runs in the execution configuration
+            executable = True,
+            allow_files = True,
+            doc = "Internal: Long-lived javac process used to validate generated Java code.",
+        ),
     },
     outputs = {
         # This isn't strictly needed if declared in the implementation,
@@ -209,6 +229,9 @@ def _natty_header_impl(ctx):
     args.add("--llm_model", ctx.attr.llm_model)
     args.add("--temperature", ctx.attr.temperature)
     args.add("--max_output_tokens", ctx.attr.max_output_tokens)
+    # Persistent workers require the arguments to be passed via a param file.
+    args.use_param_file("@%s", use_always = True)
+    args.set_param_file_format("multiline")
 
     # This is generating the usage description and prepending it as a file-level javadoc comment
     # on the raw header generated above so that we can try providing the LLM consumer the 
@@ -221,6 +244,11 @@ def _natty_header_impl(ctx):
         outputs = [output_file],
         progress_message = "Generating Natty usage description for {0}".format(ctx.label),
         mnemonic = "NattyUsageDescriptionGenerator",
+        execution_requirements = {
+            "supports-workers": "1",
+            "supports-multiplex-workers": "1",
+            "requires-worker-protocol": "json",
+        },
         # Enable LLM_API_KEY env var to be passed along to nattyc via --action_env=LLM_API_KEY=foo
         # Also allows the javac command installed on the machine to be used rather than Bazel's
         # builtin javac toolchain. TODO! Make this use the hermetic javac toolchain.